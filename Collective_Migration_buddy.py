@@ -23,10 +23,19 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE. 
 
 
-from ij.plugin import ZProjector, Duplicator, HyperStackConverter
-from ij import WindowManager, IJ, ImagePlus, ImageStack
+from ij.plugin import ZProjector, Duplicator, HyperStackConverter, FolderOpener
+from ij import WindowManager, IJ, ImagePlus, ImageStack, Prefs
 from ij.gui import GenericDialog
+from ij.io import DirectoryChooser
+from ij.process import Blitter, FloatProcessor, FHT
+from ij.process import ByteProcessor, ShortProcessor
+from ij.measure import ResultsTable
+from jarray import array, zeros
+from bisect import bisect_left, bisect_right
+from java.util.concurrent import Callable, Executors
+from java.lang import System
 import math
+import os
 
 
 def setupDialog(imp):
@@ -55,7 +64,7 @@ def setupDialog(imp):
     else:
         default_interval = 8
         default_timeunit = "min"
-		
+
     gd.addNumericField("Frame interval:", default_interval, 2)  #show 2 decimals    
     gd.addCheckbox("Do you want to use a gliding window?", True)
     gd.addCheckbox("Project hyperStack? "+
@@ -70,15 +79,705 @@ def setupDialog(imp):
     
     gd.addChoice("Method to use for frame projection:", methods_as_strings,
                  methods_as_strings[5])
+    gd.addCheckbox("Stream frames from disk and save projections as they "+
+                   "are made", imp.getStack().isVirtual())
+    gd.addCheckbox("Measure the flow between consecutive projected frames "+
+                   "(PIV)", False)
+    gd.addNumericField("PIV interrogation window size (pixels, power of 2):",
+                       32, 0)
     
     gd.showDialog()  
-	  
+
     if gd.wasCanceled():  
         IJ.log("User canceled dialog!") 
         return
 
     return gd
 
+
+class SlidingProjector(object):
+    """
+    Projects gliding windows of frames, giving the same result as a ZProjector
+    with setStartSlice(start) and setStopSlice(start+span) for every start.
+
+    Sum, Average and Standard Deviation keep a running sum, and for the
+    Standard Deviation a running sum of squares, in FloatProcessors. The
+    Blitter adds the frame entering and subtracts the frame leaving the
+    window. Sums of 8- and 16-bit frames stay exact in float as long as
+    they stay below 2^24. For the Standard Deviation the frames are summed
+    minus the first frame, which keeps the sums small and the variance
+    accurate. Max and Min can't be undone by subtracting, so they use the
+    van Herk/Gil-Werman scheme: the frames are cut into blocks as long as a
+    window, and every block keeps running projections from its first frame
+    forwards and from its last frame backwards. Any window then spans at
+    most two blocks and is the combination of one backward and one forward
+    projection. Either way each new window costs O(pixels), whatever its
+    length. Median keeps the values of every pixel over the window sorted
+    in a compact short array, which a new frame updates with one insertion
+    and one deletion per pixel.
+
+    The running sums hold the frames of the current window and two or three
+    float frames. The van Herk blocks hold two running projections for every
+    frame of up to two blocks, about four windows' worth of frames.
+
+    Windows are clamped to the last frame and have to be requested with
+    increasing start frames.
+
+    Args:
+        frame (function): Returns the ij.process.ImageProcessor of a frame,
+            frames are numbered from 1.
+        n_frames (int): Number of frames available.
+        method (int): One of ZProjector.AVG_METHOD, MAX_METHOD, MIN_METHOD,
+            SUM_METHOD, SD_METHOD or MEDIAN_METHOD.
+        span (int): A window covers the frames start to start+span.
+    """
+
+    blitter_modes = {ZProjector.MAX_METHOD: Blitter.MAX,
+                     ZProjector.MIN_METHOD: Blitter.MIN}
+
+    running_methods = (ZProjector.SUM_METHOD, ZProjector.AVG_METHOD,
+                       ZProjector.SD_METHOD)
+
+    def __init__(self, frame, n_frames, method, span):
+        self.frame = frame
+        self.n_frames = n_frames
+        self.method = method
+        self.length = span + 1
+
+        #block number -> (forward projections, backward projections)
+        self.blocks = {}
+
+        #running sums for Sum, Average and Standard Deviation and sorted
+        #values for the Median, all over the window [lo, hi]
+        self.lo, self.hi = 1, 0
+        self.width = self.height = None
+        self.sum = self.sum2 = self.offset = None
+        self.sorted_values = None
+        self.window_frames = {}
+
+    def project(self, start):
+        """
+        Projects the window starting at a frame.
+
+        Args:
+            start (int): First frame of the window.
+
+        Returns:
+            ij.process.ImageProcessor: Float for Average, Sum and Standard
+                Deviation, same type as the frames for Max and Min.
+        """
+
+        stop = min(start + self.length - 1, self.n_frames)
+
+        if self.method in self.running_methods:
+            return self._runningSum(start, stop)
+
+        if self.method == ZProjector.MEDIAN_METHOD:
+            return self._median(start, stop)
+
+        first_block = (start - 1) // self.length
+        last_block = (stop - 1) // self.length
+
+        for block in self.blocks.keys():
+            if block < first_block:
+                del self.blocks[block]
+
+        backward = self._block(first_block)[1]
+        ip = backward[start - 1 - first_block*self.length].duplicate()
+
+        if last_block != first_block:
+            forward = self._block(last_block)[0]
+            ip.copyBits(forward[stop - 1 - last_block*self.length], 0, 0,
+                        self.blitter_modes[self.method])
+
+        return ip
+
+    def _block(self, block):
+        """
+        Returns the forward and backward running projections of a block,
+        computing them the first time the block is needed.
+        """
+
+        if block not in self.blocks:
+            first = block*self.length + 1
+            last = min(first + self.length - 1, self.n_frames)
+            mode = self.blitter_modes[self.method]
+
+            frames = [self.frame(frame) for frame in range(first, last+1)]
+
+            forward = [frames[0].duplicate()]
+            for ip in frames[1:]:
+                running = forward[-1].duplicate()
+                running.copyBits(ip, 0, 0, mode)
+                forward.append(running)
+
+            backward = [frames[-1].duplicate()]
+            for ip in reversed(frames[:-1]):
+                running = backward[-1].duplicate()
+                running.copyBits(ip, 0, 0, mode)
+                backward.append(running)
+            backward.reverse()
+
+            self.blocks[block] = (forward, backward)
+
+        return self.blocks[block]
+
+    def _slide(self, start, stop, add, remove):
+        """
+        Moves the window to [start, stop], calling add and remove with the
+        ImageProcessor of every frame entering and leaving it. Frames leave
+        first, so the window never holds more than its length.
+        """
+
+        while self.lo < start and self.lo <= self.hi:
+            remove(self.window_frames.pop(self.lo))
+            self.lo += 1
+
+        #an empty window jumps straight to the new start
+        if self.lo < start:
+            self.lo, self.hi = start, start - 1
+
+        while self.hi < stop:
+            self.hi += 1
+            ip = self.frame(self.hi)
+            self.window_frames[self.hi] = ip
+            add(ip)
+
+    def _runningSum(self, start, stop):
+        """
+        Moves the running sums to the window [start, stop] and returns its
+        sum, average or standard deviation, computed like the ZProjector
+        does.
+        """
+
+        standard_deviation = self.method == ZProjector.SD_METHOD
+        if self.sum is None:
+            self._size()
+            self.sum = FloatProcessor(self.width, self.height)
+            if standard_deviation:
+                self.sum2 = FloatProcessor(self.width, self.height)
+                self.offset = self.frame(start).convertToFloat()
+
+        def values(ip):
+            if not standard_deviation:
+                return ip.convertToFloat()
+            #a float frame converts to itself, so copy it before subtracting
+            if ip.getBitDepth() == 32:
+                fp = ip.duplicate()
+            else:
+                fp = ip.convertToFloat()
+            fp.copyBits(self.offset, 0, 0, Blitter.SUBTRACT)
+            return fp
+
+        def update(ip, mode):
+            fp = values(ip)
+            self.sum.copyBits(fp, 0, 0, mode)
+            if standard_deviation:
+                fp.sqr()
+                self.sum2.copyBits(fp, 0, 0, mode)
+
+        self._slide(start, stop, lambda ip: update(ip, Blitter.ADD),
+                    lambda ip: update(ip, Blitter.SUBTRACT))
+
+        n = float(stop - start + 1)
+        if self.method == ZProjector.SUM_METHOD:
+            return self.sum.duplicate()
+
+        if self.method == ZProjector.AVG_METHOD:
+            ip = self.sum.duplicate()
+            ip.multiply(1.0/n)
+            return ip
+
+        if n < 2:
+            return FloatProcessor(self.width, self.height)
+
+        #(n*sum2 - sum*sum)/(n*(n-1)), sqrt() sets the negative rounding
+        #errors to 0
+        square = self.sum.duplicate()
+        square.sqr()
+        square.multiply(1.0/n)
+        ip = self.sum2.duplicate()
+        ip.copyBits(square, 0, 0, Blitter.SUBTRACT)
+        ip.multiply(1.0/(n - 1.0))
+        ip.sqrt()
+
+        return ip
+
+    def _median(self, start, stop):
+        """
+        Moves the sorted per-pixel windows to [start, stop] and returns their
+        medians, the mean of the two middle values for even windows like the
+        ZProjector. Only for 8- and 16-bit frames.
+
+        The sorted values of all pixels share one short array, a run of one
+        window length per pixel, shifted by 32768 so that the signed shorts
+        sort like the unsigned pixel values. A frame is inserted and removed
+        by bisection and a native copy of the tail of every run, so nothing
+        is sorted again and the values take two bytes each.
+        """
+
+        n = self._size()
+        length = self.length
+        if self.sorted_values is None:
+            self.sorted_values = zeros(n*length, 'h')
+            self.count = 0
+            self.mask = (1 << self.frame(1).getBitDepth()) - 1
+        values = self.sorted_values
+        mask = self.mask
+
+        def add(ip):
+            pixels = ip.getPixels()
+            m = self.count
+            for i in xrange(n):
+                v = (pixels[i] & mask) - 32768
+                run = i*length
+                pos = bisect_right(values, v, run, run + m)
+                System.arraycopy(values, pos, values, pos + 1, run + m - pos)
+                values[pos] = v
+            self.count += 1
+
+        def remove(ip):
+            pixels = ip.getPixels()
+            self.count -= 1
+            m = self.count
+            for i in xrange(n):
+                v = (pixels[i] & mask) - 32768
+                run = i*length
+                pos = bisect_left(values, v, run, run + m + 1)
+                System.arraycopy(values, pos + 1, values, pos, run + m - pos)
+
+        self._slide(start, stop, add, remove)
+
+        middle = self.count // 2
+        if self.count % 2:
+            result = [values[run + middle] + 32768
+                      for run in xrange(0, n*length, length)]
+        else:
+            result = [(values[run + middle - 1] + values[run + middle])/2.0
+                      + 32768 for run in xrange(0, n*length, length)]
+
+        return FloatProcessor(self.width, self.height, array(result, 'f'))
+
+    def _size(self):
+        """
+        Returns the number of pixels in a frame.
+        """
+
+        if self.width is None:
+            ip = self.frame(1)
+            self.width, self.height = ip.getWidth(), ip.getHeight()
+
+        return self.width*self.height
+
+
+def projectWindow(frame, start, stop, method):
+    """
+    Projects the frames start to stop with a ZProjector. The frames are
+    gathered in a stack of their own, sharing the pixel arrays, so that
+    every thread can run its own ZProjector.
+
+    Args:
+        frame (function): Returns the ij.process.ImageProcessor of a frame.
+        start (int): First frame of the window.
+        stop (int): Last frame of the window.
+        method (int): One of the ZProjector methods.
+
+    Returns:
+        ij.process.ImageProcessor: The projected frame.
+    """
+
+    window = None
+    for n in range(start, stop+1):
+        ip = frame(n)
+        if window is None:
+            window = ImageStack(ip.getWidth(), ip.getHeight())
+        window.addSlice(ip)
+
+    zp = ZProjector(ImagePlus("window", window))
+    zp.setMethod(method)
+    zp.setStartSlice(1)
+    zp.setStopSlice(window.getSize())
+    zp.doProjection()
+
+    return zp.getProjection().getProcessor()
+
+
+class ProjectionTask(Callable):
+    """
+    Projects a run of consecutive windows of one channel and puts the results
+    straight into their slices of a preallocated output stack.
+
+    Args:
+        frame (function): Returns the ij.process.ImageProcessor of a frame of
+            this channel.
+        n_frames (int): Number of frames available.
+        method (int): One of the ZProjector methods.
+        span (int): A window covers the frames start to start+span.
+        starts (list): (output slice, window start) pairs, in increasing
+            order of window start.
+        outstack (ij.ImageStack): Output stack to fill.
+        sliding (bool): Use a SlidingProjector rather than the ZProjector.
+    """
+
+    def __init__(self, frame, n_frames, method, span, starts, outstack,
+                 sliding):
+        self.frame = frame
+        self.n_frames = n_frames
+        self.method = method
+        self.span = span
+        self.starts = starts
+        self.outstack = outstack
+        self.sliding = sliding
+
+    def call(self):
+        if self.sliding:
+            projector = SlidingProjector(self.frame, self.n_frames,
+                                         self.method, self.span)
+
+        for index, start in self.starts:
+            if self.sliding:
+                ip = projector.project(start)
+            else:
+                ip = projectWindow(self.frame, start,
+                                   min(start+self.span, self.n_frames),
+                                   self.method)
+            self.outstack.setProcessor(ip, index)
+
+        return len(self.starts)
+
+
+def projectWindows(imp, window_starts, method, span, sliding):
+    """
+    Projects the windows of every channel of an image on a pool of threads.
+
+    Each channel's windows are cut into one run of consecutive windows per
+    thread. A SlidingProjector has to walk its windows in order, so every
+    run gets its own, at the price of filling one window more per run.
+
+    Args:
+        imp (ij.ImagePlus): Image to project, a single z-slice per frame.
+        window_starts (list): First frame of every window.
+        method (int): One of the ZProjector methods.
+        span (int): A window covers the frames start to start+span.
+        sliding (bool): Use SlidingProjectors rather than the ZProjector.
+
+    Returns:
+        ij.ImageStack: The projections, channels interleaved window by window.
+    """
+
+    stack = imp.getStack()
+    n_channels = imp.getNChannels()
+    n_threads = Prefs.getThreads()
+    outstack = ImageStack(imp.getWidth(), imp.getHeight(),
+                          len(window_starts)*n_channels)
+
+    run_length = max(1, -(-len(window_starts) // n_threads))
+    tasks = []
+    for channel in range(1, n_channels+1):
+        frame = lambda n, channel=channel: stack.getProcessor(
+            imp.getStackIndex(channel, 1, n))
+        starts = [(window*n_channels + channel, start)
+                  for window, start in enumerate(window_starts)]
+        for i in range(0, len(starts), run_length):
+            tasks.append(ProjectionTask(frame, imp.getNFrames(), method, span,
+                                        starts[i:i+run_length], outstack,
+                                        sliding))
+
+    if not tasks:
+        return outstack
+
+    executor = Executors.newFixedThreadPool(min(len(tasks), n_threads))
+    try:
+        for future in executor.invokeAll(tasks):
+            future.get()
+    finally:
+        executor.shutdown()
+
+    return outstack
+
+
+def newFolder(path):
+    """
+    Creates a new, empty folder, numbering the name if the path is taken.
+
+    Args:
+        path (str): Wanted path of the folder.
+
+    Returns:
+        str: Path of the created folder.
+    """
+
+    folder = path
+    number = 1
+    while os.path.exists(folder):
+        number += 1
+        folder = path+"_"+str(number)
+    os.makedirs(folder)
+
+    return folder
+
+
+def streamWindows(imp, channels, first_frame, n_frames, window_starts, method,
+                  span, sliding, folder, name):
+    """
+    Projects the windows one at a time, reading the frames straight from the
+    stack of the image, which may be virtual, and saving every projected
+    frame to a folder as soon as it is made. Only the frames of the current
+    windows are held in memory, plus for sliding Max and Min the running
+    projections of the blocks they span, see SlidingProjector.
+
+    Args:
+        imp (ij.ImagePlus): Image to project, a single z-slice per frame.
+        channels (list): Channels to project.
+        first_frame (int): Frame of the image that is frame 1 of the windows.
+        n_frames (int): Number of frames available from first_frame on.
+        window_starts (list): First frame of every window.
+        method (int): One of the ZProjector methods.
+        span (int): A window covers the frames start to start+span.
+        sliding (bool): Use SlidingProjectors rather than the ZProjector.
+        folder (str): Folder to save the projected frames in.
+        name (str): Start of the file names.
+
+    Returns:
+        ij.ImagePlus: The saved projections opened as a virtual stack,
+            channels interleaved window by window.
+    """
+
+    stack = imp.getStack()
+    frames = [lambda n, channel=channel: stack.getProcessor(
+                  imp.getStackIndex(channel, 1, first_frame+n-1))
+              for channel in channels]
+
+    if sliding:
+        projectors = [SlidingProjector(frame, n_frames, method, span)
+                      for frame in frames]
+
+    window_digits = len(str(len(window_starts)))
+    channel_digits = len(str(len(channels)))
+    for window, start in enumerate(window_starts):
+        for channel, frame in enumerate(frames):
+            if sliding:
+                ip = projectors[channel].project(start)
+            else:
+                ip = projectWindow(frame, start, min(start+span, n_frames),
+                                   method)
+            file_name = "%s_t%0*d_c%0*d.tif" % (name, window_digits, window+1,
+                                                channel_digits, channel+1)
+            IJ.saveAsTiff(ImagePlus(file_name, ip),
+                          os.path.join(folder, file_name))
+        IJ.showProgress(window+1, len(window_starts))
+
+    return FolderOpener.open(folder, "virtual")
+
+
+def processorView(ip):
+    """
+    Makes a new ImageProcessor sharing the pixel array of ip, no pixels are
+    copied. Rois can be set on the view without disturbing other threads
+    cropping the same frame.
+
+    Args:
+        ip (ij.process.ImageProcessor): 8-bit, 16-bit or 32-bit frame.
+
+    Returns:
+        ij.process.ImageProcessor: The view.
+    """
+
+    w = ip.getWidth()
+    h = ip.getHeight()
+
+    if isinstance(ip, ByteProcessor):
+        return ByteProcessor(w, h, ip.getPixels(), None)
+    if isinstance(ip, ShortProcessor):
+        return ShortProcessor(w, h, ip.getPixels(), None)
+    return FloatProcessor(w, h, ip.getPixels(), None)
+
+
+def correlationPeak(plan, tile1, tile2):
+    """
+    Finds the displacement from one interrogation window to the next by
+    FFT cross-correlation, using ImageJ's Hartley transform.
+
+    Args:
+        plan (ij.process.FHT): FHT of the window size whose sine, cosine and
+            bit reversal tables are reused for every transform. A plan must
+            only be used by one thread at a time.
+        tile1 (ij.process.FloatProcessor): Window in the first frame, mean
+            subtracted, the size a power of 2.
+        tile2 (ij.process.FloatProcessor): Same window in the next frame.
+
+    Returns:
+        tuple: (u, v) displacement in pixels, with sub-pixel precision from a
+            parabola through the correlation peak and its neighbours.
+    """
+
+    size = tile1.getWidth()
+    fht1 = FHT(tile1)
+    fht2 = FHT(tile2)
+    plan.rc2DFHT(fht1.getPixels(), False, size)
+    plan.rc2DFHT(fht2.getPixels(), False, size)
+
+    #second frame times the conjugate of the first peaks at the displacement
+    correlation = fht2.conjugateMultiply(fht1).getPixels()
+    plan.rc2DFHT(correlation, True, size)
+
+    values = list(correlation)
+    peak = max(values)
+    y, x = divmod(values.index(peak), size)
+
+    def subpixel(before, after):
+        curvature = before - 2*peak + after
+        if curvature < 0:
+            return 0.5*(before - after)/curvature
+        return 0.0
+
+    #the correlation is not quadrant swapped, zero displacement is at (0, 0)
+    u = ((x + size/2) % size) - size/2 + subpixel(
+        values[y*size + (x-1) % size], values[y*size + (x+1) % size])
+    v = ((y + size/2) % size) - size/2 + subpixel(
+        values[((y-1) % size)*size + x], values[((y+1) % size)*size + x])
+
+    return u, v
+
+
+class PIVTask(Callable):
+    """
+    Measures the displacement of a set of interrogation windows between two
+    frames.
+
+    Args:
+        plan (ij.process.FHT): Transform plan of this task, see
+            correlationPeak.
+        ip1 (ij.process.ImageProcessor): First frame.
+        ip2 (ij.process.ImageProcessor): Next frame.
+        positions (list): (x, y) top left corners of the windows.
+        size (int): Window size.
+    """
+
+    def __init__(self, plan, ip1, ip2, positions, size):
+        self.plan = plan
+        self.ip1 = ip1
+        self.ip2 = ip2
+        self.positions = positions
+        self.size = size
+
+    def tile(self, ip, x, y):
+        ip.setRoi(x, y, self.size, self.size)
+        tile = ip.crop().convertToFloat()
+        mean = tile.getStatistics().mean
+        tile.subtract(mean)
+        return tile
+
+    def call(self):
+        vectors = []
+        for x, y in self.positions:
+            tile1 = self.tile(self.ip1, x, y)
+            tile2 = self.tile(self.ip2, x, y)
+            #featureless windows have no correlation peak
+            if (tile1.getStatistics().stdDev == 0 or
+                    tile2.getStatistics().stdDev == 0):
+                continue
+            u, v = correlationPeak(self.plan, tile1, tile2)
+            vectors.append((x + self.size/2, y + self.size/2, u, v))
+
+        return vectors
+
+
+def particleImageVelocimetry(imp, channel, size, first_frame=1,
+                             n_frames=None):
+    """
+    Measures the flow field between every pair of consecutive frames of a
+    channel with particle image velocimetry. Interrogation windows overlap by
+    half their size and are spread over a pool of threads, every thread
+    keeping its own transform plan for all frames.
+
+    Args:
+        imp (ij.ImagePlus): Image to analyze, a single z-slice per frame.
+        channel (int): Channel to analyze.
+        size (int): Interrogation window size, a power of 2.
+        first_frame (int): First frame to analyze.
+        n_frames (int): Number of frames to analyze, all from first_frame on
+            if None.
+
+    Returns:
+        tuple: ij.measure.ResultsTable with the vectors of every frame pair,
+            and one with their mean speed and order parameter, the length of
+            the mean velocity over the mean speed.
+    """
+
+    if size < 4 or size & (size - 1):
+        raise Exception("The PIV window size must be a power of 2!")
+    if n_frames is None:
+        n_frames = imp.getNFrames() - first_frame + 1
+
+    calibration = imp.getCalibration()
+    pixel_size = calibration.pixelWidth
+    unit = calibration.getUnit()
+    frame_interval = calibration.frameInterval
+    if frame_interval <= 0:
+        frame_interval = 1.0
+
+    step = size/2
+    positions = [(x, y) for y in range(0, imp.getHeight()-size+1, step)
+                 for x in range(0, imp.getWidth()-size+1, step)]
+    n_threads = min(Prefs.getThreads(), max(1, len(positions)))
+    plans = [FHT(FloatProcessor(size, size)) for i in range(n_threads)]
+
+    vectors = ResultsTable()
+    summary = ResultsTable()
+    stack = imp.getStack()
+    executor = Executors.newFixedThreadPool(n_threads)
+    try:
+        ip1 = stack.getProcessor(imp.getStackIndex(channel, 1, first_frame))
+        for frame in range(1, n_frames):
+            ip2 = stack.getProcessor(imp.getStackIndex(channel, 1,
+                                                       first_frame+frame))
+            #every task crops from its own views, with their own rois
+            tasks = [PIVTask(plans[i], processorView(ip1), processorView(ip2),
+                             positions[i::n_threads], size)
+                     for i in range(n_threads)]
+
+            sum_u = sum_v = sum_speed = 0.0
+            n_vectors = 0
+            for future in executor.invokeAll(tasks):
+                for x, y, u, v in future.get():
+                    u = u*pixel_size/frame_interval
+                    v = v*pixel_size/frame_interval
+                    speed = math.hypot(u, v)
+                    vectors.incrementCounter()
+                    vectors.addValue("Frame", frame)
+                    vectors.addValue("X", x*pixel_size)
+                    vectors.addValue("Y", y*pixel_size)
+                    vectors.addValue("U", u)
+                    vectors.addValue("V", v)
+                    vectors.addValue("Speed", speed)
+                    sum_u += u
+                    sum_v += v
+                    sum_speed += speed
+                    n_vectors += 1
+
+            summary.incrementCounter()
+            summary.addValue("Frame", frame)
+            summary.addValue("Time", (frame-1)*frame_interval)
+            if n_vectors:
+                summary.addValue("Mean speed", sum_speed/n_vectors)
+            else:
+                summary.addValue("Mean speed", float('nan'))
+            if sum_speed > 0:
+                summary.addValue("Order parameter",
+                                 math.hypot(sum_u, sum_v)/sum_speed)
+            else:
+                summary.addValue("Order parameter", float('nan'))
+            IJ.showProgress(frame, n_frames-1)
+            ip1 = ip2
+    finally:
+        executor.shutdown()
+
+    IJ.log("PIV velocities in "+unit+"/"+calibration.getTimeUnit())
+
+    return vectors, summary
+
+
 #Start by getting the active image window
 imp = WindowManager.getCurrentImage()
 
@@ -98,6 +797,19 @@ methods_as_const=[ZProjector.AVG_METHOD, ZProjector.MAX_METHOD,
 
 medthod_dict=dict(zip(methods_as_strings, methods_as_const))
 
+#projection methods the SlidingProjector can do incrementally
+sliding_methods=[ZProjector.AVG_METHOD, ZProjector.MAX_METHOD,
+                 ZProjector.MIN_METHOD, ZProjector.SUM_METHOD,
+                 ZProjector.SD_METHOD]
+
+#NaNs in 32-bit stacks can't be kept sorted, leave those to the ZProjector
+if imp.getBitDepth() in (8, 16):
+    sliding_methods.append(ZProjector.MEDIAN_METHOD)
+
+#the sliding median updates every pixel in interpreted code, which only
+#beats sorting the window natively in the ZProjector for long windows
+sliding_median_min_frames = 100
+
 # Run the setupDialog, read out and store the options
 gd=setupDialog(imp)
 
@@ -105,6 +817,8 @@ frame_interval = gd.getNextNumber()
 time_unit = gd.getNextString()
 glidingFlag = gd.getNextBoolean()
 hyperstackFlag = gd.getNextBoolean()
+streamFlag = gd.getNextBoolean()
+pivFlag = gd.getNextBoolean()
 
 #Set the frame interval and unit, and store it in the ImagePlus calibration
 cal.frameInterval = frame_interval
@@ -119,56 +833,107 @@ if (start_frame > stop_frame):
     IJ.showMessage("Start frame > Stop frame, can't go backwards in time!")
     raise Exception("Start frame > Stop frame!")
 
-if ((start_frame != 1) or (stop_frame != imp.getNFrames())):
-    imp = Duplicator().run(imp, 1, nChannels, 1, nSlices, start_frame,
-                           stop_frame)
-    
- 
-no_frames_per_integral = int(gd.getNextNumber())
-
-#the doHyperstackProjection method can't project past the end of the stack
-if hyperstackFlag: 
-	total_no_frames_to_project=imp.getNFrames()-no_frames_per_integral
-#doProjection method can project past the end, it adds black frames at the end
-
 #if not projecting hyperstacks, just copy the current active channel
+nChannels = imp.getNChannels()
+if hyperstackFlag:
+    first_channel, last_channel = 1, nChannels
 else:
-	total_no_frames_to_project=imp.getNFrames()
-	
-    imp = Duplicator().run(imp, current_channel, current_channel, 1, nSlices,
+    first_channel = last_channel = current_channel
+
+#when streaming the frames are read one by one from the original stack
+if (((start_frame != 1) or (stop_frame != imp.getNFrames()) or
+        not hyperstackFlag) and not streamFlag):
+    imp = Duplicator().run(imp, first_channel, last_channel, 1, nSlices,
                            start_frame, stop_frame)
 
-#The Z-Projection magic happens here through a ZProjector object
-zp = ZProjector(imp)
+n_frames = stop_frame - start_frame + 1
+no_frames_per_integral = int(gd.getNextNumber())
+piv_window = int(gd.getNextNumber())
 
 projection_method=gd.getNextChoice()
 chosen_method=medthod_dict[projection_method]
-zp.setMethod(chosen_method)
-outstack=imp.createEmptyStack()
 
-if glidingFlag:
-	frames_to_advance_per_step = 1
-else:
-	frames_to_advance_per_step = no_frames_per_integral
+#0 frames per projection leaves the frames as they are, for the PIV only
+if no_frames_per_integral == 0:
+    if not pivFlag:
+        IJ.showMessage("Nothing to do with 0 frames per projection "+
+                       "and no PIV!")
+        raise Exception("Nothing to do!")
+    imp2 = imp
+    output_title = title
+    #when streaming the frames were not duplicated
+    if streamFlag:
+        piv_channel = current_channel
+        piv_first_frame = start_frame
+    else:
+        piv_channel = current_channel - first_channel + 1
+        piv_first_frame = 1
 
-for frame in range(1, total_no_frames_to_project, frames_to_advance_per_step):
-    zp.setStartSlice(frame)
-    zp.setStopSlice(frame+no_frames_per_integral)
+else:
+    #the doHyperstackProjection method can't project past the end of the stack
     if hyperstackFlag:
-    	zp.doHyperStackProjection(False)
-    	projected_stack = zp.getProjection().getStack()
-    	for channel in range(projected_stack.getSize()):
-    		outstack.addSlice(projected_stack.getProcessor(channel+1))
+        total_no_frames_to_project=n_frames-no_frames_per_integral
+    #otherwise windows running past the end are cut at the last frame
     else:
-    	zp.doProjection()
-    	outstack.addSlice(zp.getProjection().getProcessor())
-
-#Create an image processor from the newly created Z-projection stack
-nChannels = imp.getNChannels()
-nFrames = outstack.getSize()/nChannels
-imp2=ImagePlus(title+'_'+projection_method+'_'+str(no_frames_per_integral)+'_frames', outstack)
-imp2 = HyperStackConverter.toHyperStack(imp2, nChannels, nSlices, nFrames)
-imp2.show()
-    
-
+        total_no_frames_to_project=n_frames
 
+    if glidingFlag:
+        frames_to_advance_per_step = 1
+    else:
+        frames_to_advance_per_step = no_frames_per_integral
+
+    window_starts = range(1, total_no_frames_to_project,
+                          frames_to_advance_per_step)
+    if not window_starts:
+        IJ.showMessage("Too few frames for a window of "+
+                       str(no_frames_per_integral)+" frames!")
+        raise Exception("Too few frames to project!")
+
+    #consecutive gliding windows share all but one frame, so update them
+    #incrementally where the SlidingProjector can and it pays off
+    slidingFlag = (glidingFlag and chosen_method in sliding_methods and
+                   (chosen_method != ZProjector.MEDIAN_METHOD or
+                    no_frames_per_integral+1 >= sliding_median_min_frames))
+    output_title = (title+'_'+projection_method+'_'+
+                    str(no_frames_per_integral)+'_frames')
+
+    #The Z-Projection magic happens here
+    if streamFlag:
+        folder = DirectoryChooser("Folder to save the projected frames in"
+                                  ).getDirectory()
+        if folder is None:
+            raise Exception("No folder chosen for the projected frames!")
+        #a new folder of its own, the projections are reopened as all files
+        #in it
+        folder = newFolder(os.path.join(folder, output_title))
+        imp2 = streamWindows(imp, range(first_channel, last_channel+1),
+                             start_frame, n_frames, window_starts,
+                             chosen_method, no_frames_per_integral,
+                             slidingFlag, folder, output_title)
+        imp2.setTitle(output_title)
+
+    #windows and channels spread over threads
+    else:
+        outstack = projectWindows(imp, window_starts, chosen_method,
+                                  no_frames_per_integral, slidingFlag)
+        imp2=ImagePlus(output_title, outstack)
+
+    #Create a hyperstack from the newly created Z-projection stack
+    nChannels = last_channel - first_channel + 1
+    nFrames = imp2.getStackSize()/nChannels
+    imp2 = HyperStackConverter.toHyperStack(imp2, nChannels, nSlices, nFrames)
+    cal2 = cal.copy()
+    cal2.frameInterval = frame_interval*frames_to_advance_per_step
+    imp2.setCalibration(cal2)
+    imp2.show()
+
+    piv_channel = current_channel - first_channel + 1
+    piv_first_frame = 1
+    n_frames = nFrames
+
+#Particle image velocimetry between consecutive projected frames
+if pivFlag:
+    piv_vectors, piv_summary = particleImageVelocimetry(
+        imp2, piv_channel, piv_window, piv_first_frame, n_frames)
+    piv_vectors.show(output_title+"_PIV_vectors")
+    piv_summary.show(output_title+"_PIV_summary")
@@ -1,6 +1,32 @@
 """
 This plugin is extensively based on the Jython FRAP analysis script from:
 http://fiji.sc/Analyze_FRAP_movies_with_a_Jython_script
+
+Run with an image open it analyzes that image, using the first two ROIs in
+the RoiManager as FRAP and normalizing roi, and a further roi named
+Background (or Bg), if there is one, as background. With no image open, or
+headless with the macro option batch=<folder>, every movie in the folder is
+analyzed with the ROI set zip of the same name (movie.zip or
+movie_RoiSet.zip). Uncompressed TIFF files without a density calibration
+are not opened, only the rows under the rois are read from disk. If rois
+are named FRAP, each of them is analyzed as a bleach spot, with the rois
+named Ref (or Norm) and Background (or Bg) as shared normalizing and
+background roi.
+
+Further batch options:
+channel=        channel to analyze
+frames=         number of frames to analyze
+interval=       frame interval, used if a movie has none
+bleach=         first post bleach frame, detected automatically if left out
+models=         comma separated, from exp, exp_offset, double_exp and
+                soumpasis
+criterion=      AIC or BIC, picks the best of the models
+bootstrap=      number of refits for 95% confidence intervals of t-half
+                and mobile fraction
+normalization=  bleach_depth, double or full_scale. Double normalized
+                curves do not start at 0, so exp is fitted as exp_offset
+global=         exp or exp_offset, fits all movies together with one shared
+                recovery rate and an amplitude per movie
 """
 
 import java.awt.Color as Color
@@ -10,12 +36,26 @@ from ij.process import ImageStatistics as ImageStatistics
 from ij.measure import Measurements as Measurements
 from ij.measure import ResultsTable
 from ij import IJ as IJ
+from ij import ImagePlus, ImageStack
+from ij.process import FloatProcessor
 from ij.measure import CurveFitter as CurveFitter
+from ij.measure import UserFunction
 from ij.gui import Plot as Plot
 from ij.gui import PlotWindow as PlotWindow	
 from ij.gui import GenericDialog
-from ij.plugin import ChannelSplitter
+from ij import Macro, Prefs
+from ij.io import DirectoryChooser, RoiDecoder, TiffDecoder, FileInfo
+from java.awt import GraphicsEnvironment
+from java.io import ByteArrayOutputStream, RandomAccessFile
+from java.nio import ByteBuffer, ByteOrder
+from java.lang import Throwable
+from java.util.concurrent import Callable, Executors
+from java.util.zip import ZipFile
+from jarray import array, zeros
 import math
+import os
+import random
+from operator import mul
 
 def FRAPsetupDialog(imp):
 
@@ -34,6 +74,13 @@ def FRAPsetupDialog(imp):
 	gd.addCheckbox("Automatic post bleach frame detection?", True)
 	gd.addNumericField("First post bleach frame:", 6, 0)
 	gd.addMessage("Automatic checkbox has to be unchecked for maual selection to work")
+	gd.addCheckbox("Pixel-wise recovery maps of the FRAP roi", False)
+	gd.addCheckbox("Fit an offset in the recovery maps", False)
+	for model in FRAP_model_keys[1:]:
+		gd.addCheckbox("Also fit " + FRAP_models[model][0].lower(), False)
+	gd.addChoice("Rank the fitted models by:", ['AIC', 'BIC'], 'AIC')
+	gd.addNumericField("Bootstrap refits for 95% confidence intervals (0 = off):", 0, 0)
+	gd.addChoice("Normalization:", normalization_names, normalization_names[0])
 		
 	gd.showDialog()  
 	  
@@ -47,6 +94,15 @@ def FRAPsetupDialog(imp):
 	max_frame = int(gd.getNextNumber())
 	manual_FRAP_frame = int(gd.getNextNumber()-1) #Sic 0-index!
 	autoFRAPflag=gd.getNextBoolean()
+	mapFlag=gd.getNextBoolean()
+	mapOffsetFlag=gd.getNextBoolean()
+	models = FRAP_model_keys[:1]
+	for model in FRAP_model_keys[1:]:
+		if gd.getNextBoolean():
+			models.append(model)
+	criterion = gd.getNextChoice()
+	n_bootstrap = max(0, int(gd.getNextNumber()))
+	normalization = normalization_keys[gd.getNextChoiceIndex()]
 
 	#Set the frame interval in calibration
 
@@ -55,152 +111,1665 @@ def FRAPsetupDialog(imp):
 	
 	#Extract the desired channel
 	   
-	imp=channelSelector(imp,channel)	
+	imp=channelSelector(imp,channel,max_frame)	
   	
-	return imp, max_frame, manual_FRAP_frame, autoFRAPflag
-
-def channelSelector(imp, channelno):
-	'''
-	arguments imp: imageProcessor, channelno: imteger, channel number
-	returns an imp containing the desired channel
-	'''
-	imps=ChannelSplitter.split(imp)
-	return imps[(channelno-1)]
-
- 
-# Get ROIs
-roi_manager = RoiManager.getInstance()
-roi_list    = roi_manager.getRoisAsArray()
- 
-# We assume first one is FRAP roi, the 2nd one is normalizing roi.
-roi_FRAP    = roi_list[0];
-roi_norm    = roi_list[1];
- 
-
-# Get current image plus and image processor
-current_imp  = WindowManager.getCurrentImage()
-# Pass current imp through the FRAPsetupDialog
-current_imp, max_frame, manual_FRAP_frame, autoFRAPflag = FRAPsetupDialog(current_imp)
-stack        = current_imp.getImageStack()
-calibration  = current_imp.getCalibration()
-title		 = current_imp.getTitle()
-# Specify up to what frame to fit and plot, set in FRAPsetupDialog
-n_slices = max_frame
-
-#############################################
- 
-# Collect intensity values
- 
-# Create empty lists of number
-If = []  # Frap values
-In = []  # Norm values
- 
-# Loop over each slice of the stack
-for i in range(0, n_slices):
-  
-    # Get the current slice
-    ip = stack.getProcessor(i+1)
-  
-    # Put the ROI on it
-    ip.setRoi(roi_FRAP)
-  
-    # Make a measurement in it
-    stats = ImageStatistics.getStatistics(ip, Measurements.MEAN, calibration);
-    mean  = stats.mean
-  
-    # Store the measurement in the list
-    If.append( mean  )
- 
-    # Do the same for non-FRAPed area
-    ip.setRoi(roi_norm)
-        
-  
-# Gather image parameters
-frame_interval = calibration.frameInterval
-time_units = calibration.getTimeUnit()
-IJ.log('For image ' + title )
-IJ.log('Time interval is ' + str(frame_interval) + ' ' + time_units)
-  
-#Automatic FRAP frame detection minimal intensity value in FRAP and bleach frame
-if autoFRAPflag:
-	min_intensity = min( If )
-	bleach_frame = If.index( min_intensity )
-else:
-	min_intensity = If[manual_FRAP_frame]
-	bleach_frame = manual_FRAP_frame
-
-IJ.log('FRAP frame is ' + str(bleach_frame+1) + ' at t = ' + str(bleach_frame * frame_interval) + ' ' + time_units )
-  
-# Compute mean pre-bleach intensity
-mean_If = 0.0
-mean_In = 0.0
-for i in range(bleach_frame):         # will loop until the bleach time
-    mean_If = mean_If + If[i]
-    mean_In = mean_In + In[i]
-mean_If = mean_If / bleach_frame
-mean_In = mean_In / bleach_frame
-  
-# Calculate normalized curve
-normalized_curve = []
-for i in range(n_slices):
-    normalized_curve.append( (If[i] - min_intensity) / (mean_If - min_intensity)   *   mean_In / In[i] )
-     
-x = [i * frame_interval for i in range( n_slices ) ]
-y = normalized_curve
- 
-xtofit = [ i * frame_interval for i in range( n_slices - bleach_frame ) ]
-ytofit = normalized_curve[ bleach_frame : n_slices ]
-  
-# Fitter
-fitter = CurveFitter(xtofit, ytofit)
-fitter.doFit(CurveFitter.EXP_RECOVERY_NOOFFSET)
-IJ.log("Fit FRAP curve by " + fitter.getFormula() )
-param_values = fitter.getParams()
-IJ.log( fitter.getResultString() )
-  
-# Overlay fit curve, with oversampling (for plot)
-xfit = [ (t / 10.0  + bleach_frame) * frame_interval for t in range(10 * len(xtofit) ) ]
-yfit = []
-for xt in xfit:
-    yfit.append( fitter.f( fitter.getParams(), xt - xfit[0]) )
- 
-  
-plot = Plot("Normalized FRAP curve for " + current_imp.getTitle(), "Time ("+time_units+')', "NU", [], [])
-plot.setLimits(0, max(x), 0, 1.2 );
-plot.setLineWidth(2)
- 
- 
-plot.setColor(Color.BLACK)
-plot.addPoints(x, y, Plot.LINE)
-plot.addPoints(x,y,PlotWindow.X);
- 
-  
-plot.setColor(Color.RED)
-plot.addPoints(xfit, yfit, Plot.LINE)
- 
-plot.setColor(Color.black);
-plot_window =  plot.show()
- 
- 
-# Output FRAP parameters
-thalf = math.log(2) / param_values[1]
-mobile_fraction = param_values[0]
- 
-str1 = ('Half-recovery time = %.2f ' + time_units) % thalf
-IJ.log( str1 )
-str2 = "Mobile fraction = %.1f %%" % (100 * mobile_fraction)
-IJ.log( str2 )
-
-IJ.run("Clear Results")
-
-
-rt=ResultsTable()
-
-for i in range(len(xtofit)):
-	rt.incrementCounter()
-	rt.addValue('Time.pb',xtofit[i])
-	rt.addValue("Norm.int",ytofit[i])
-	rt.addValue("Frame.interval",frame_interval)
-rt.disableRowLabels()
-rt.show(title)
+	return (imp, max_frame, manual_FRAP_frame, autoFRAPflag, mapFlag,
+	        mapOffsetFlag, models, criterion, n_bootstrap, normalization)
+
+def channelIndices(imp, channelno, max_frame=None):
+	'''
+	arguments imp: ImagePlus, channelno: integer, channel number,
+	max_frame: integer, number of images to keep, all if None
+	returns the stack indices of the images of the channel, in the order
+	ChannelSplitter would put them, up to max_frame
+	'''
+	indices = []
+	for frame in range(1, imp.getNFrames()+1):
+		for z in range(1, imp.getNSlices()+1):
+			if len(indices) == max_frame:
+				return indices
+			indices.append(imp.getStackIndex(channelno, z, frame))
+	return indices
+
+def channelSelector(imp, channelno, max_frame=None):
+	'''
+	arguments imp: ImagePlus, channelno: integer, channel number,
+	max_frame: integer, number of frames to keep, all if None
+	returns an imp containing the desired channel, up to max_frame. Its
+	slices share their pixel arrays with imp, so nothing is copied, and of
+	a virtual stack only the kept frames are read
+	'''
+	stack = imp.getImageStack()
+	channel_stack = ImageStack(imp.getWidth(), imp.getHeight())
+	for index in channelIndices(imp, channelno, max_frame):
+		channel_stack.addSlice(stack.getSliceLabel(index),
+		                       stack.getPixels(index))
+
+	channel_imp = ImagePlus("C%d-%s" % (channelno, imp.getTitle()),
+	                        channel_stack)
+	channel_imp.setCalibration(imp.getCalibration())
+	return channel_imp
+
+def roiPixelIndices(roi, width, height, x0=0, y0=0):
+	'''
+	Rasterizes roi into the indices of the pixels it covers, so that it
+	can be measured on any number of frames without setting it again
+	arguments roi: Roi, width, height: integers, size of the pixel array,
+	x0, y0: integers, image position of the first pixel of the array
+	returns a list of indices into a width*height pixel array, pixels
+	outside of the array are left out
+	'''
+	bounds = roi.getBounds()
+	mask = roi.getMask()
+	if mask is not None:
+		mask = mask.getPixels()
+
+	indices = []
+	for y in range(bounds.height):
+		row = bounds.y + y - y0
+		if row < 0 or row >= height:
+			continue
+		for x in range(bounds.width):
+			column = bounds.x + x - x0
+			if column < 0 or column >= width:
+				continue
+			if mask is None or mask[y*bounds.width + x] != 0:
+				indices.append(row*width + column)
+
+	return indices
+
+def maskMean(pixels, indices, bit_depth, ctable=None):
+	'''
+	arguments pixels: pixel array of a frame, indices: list of integers as
+	made by roiPixelIndices, bit_depth: integer, 8, 16 or 32, ctable:
+	calibration table of 8 and 16 bit images or None
+	returns the mean value of the pixels at indices, NaN if there are none
+	'''
+	if len(indices) == 0:
+		return float('nan')
+
+	return sum(maskValues(pixels, indices, bit_depth, ctable)) / float(len(indices))
+
+def maskValues(pixels, indices, bit_depth, ctable=None):
+	'''
+	arguments as for maskMean
+	returns an iterator over the values of the pixels at indices
+	'''
+	# Java bytes and shorts are signed
+	if bit_depth == 8:
+		values = (pixels[i] & 0xff for i in indices)
+	elif bit_depth == 16:
+		values = (pixels[i] & 0xffff for i in indices)
+	else:
+		values = (pixels[i] for i in indices)
+
+	if ctable is not None and bit_depth != 32:
+		values = (ctable[v] for v in values)
+
+	return values
+
+def measureIntensities(stack, rois, n_slices, calibration):
+	'''
+	Rasterizes the rois once and collects the means of all of them in a
+	single pass over the pixel array of each slice
+	arguments stack: ImageStack, rois: list of Rois, n_slices: integer,
+	calibration: Calibration
+	returns one list per roi, with its mean intensity in each of the first
+	n_slices slices
+	'''
+	bit_depth = stack.getBitDepth()
+	if bit_depth not in [8, 16, 32]:
+		raise Exception("FRAP analysis needs an 8, 16 or 32 bit channel")
+
+	masks = [roiPixelIndices(roi, stack.getWidth(), stack.getHeight())
+	         for roi in rois]
+
+	ctable = None
+	if calibration.calibrated():
+		ctable = calibration.getCTable()
+
+	curves = [[] for roi in rois]
+	for i in range(0, n_slices):
+		pixels = stack.getPixels(i+1)
+		for mask, curve in zip(masks, curves):
+			curve.append(maskMean(pixels, mask, bit_depth, ctable))
+
+	return curves
+
+class TiffWindowReader(object):
+	'''
+	Reads rectangular windows of the images of an uncompressed TIFF file
+	straight from disk, seeking to the rows that cover the window, so that
+	a few small rois can be measured without opening the movie. Works with
+	8, 16 and 32 bit gray images stored contiguously, as ImageJ saves them,
+	or in strips, in either byte order. Images with a density calibration
+	are refused, the pixel values it reads are raw. It answers getNChannels,
+	getNSlices, getNFrames and getStackIndex like an ImagePlus, so it can
+	be used with channelIndices
+	arguments path: string, path to the TIFF file
+	'''
+	def __init__(self, path):
+		self.path = path
+		self.title = os.path.basename(path)
+		infos = TiffDecoder(os.path.dirname(path) or '.', self.title).getTiffInfo()
+		if infos is None or len(infos) == 0:
+			raise Exception("Not a TIFF file: " + path)
+
+		fi = infos[0]
+		for info in infos:
+			if info.compression > FileInfo.COMPRESSION_NONE:
+				raise Exception("Compressed TIFF files can not be read by window")
+
+		bytes_per_pixel = {FileInfo.GRAY8:1, FileInfo.GRAY16_UNSIGNED:2,
+		                   FileInfo.GRAY32_FLOAT:4}
+		if fi.fileType not in bytes_per_pixel:
+			raise Exception("Only 8, 16 and 32 bit gray TIFF files can be read by window")
+
+		self.infos = infos
+		self.width = fi.width
+		self.height = fi.height
+		self.bytes_per_pixel = bytes_per_pixel[fi.fileType]
+		self.bit_depth = 8*self.bytes_per_pixel
+		self.row_bytes = self.width*self.bytes_per_pixel
+		self.image_bytes = self.row_bytes*self.height
+		self.byte_order = ByteOrder.BIG_ENDIAN
+		if fi.intelByteOrder:
+			self.byte_order = ByteOrder.LITTLE_ENDIAN
+
+		# ImageJ describes a contiguous stack with its first image only
+		self.contiguous = len(infos) == 1
+		self.n_images = len(infos)
+		if self.contiguous:
+			self.n_images = max(1, fi.nImages)
+
+		description = {}
+		for line in (fi.description or '').split('\n'):
+			if '=' in line:
+				key, value = line.split('=', 1)
+				description[key.strip()] = value.strip()
+		self.n_channels = int(description.get('channels', 1))
+		self.n_frames = int(description.get('frames', 1))
+		# Opening the image applies the density calibration (which also
+		# holds signed 16 bit images) to the intensities, reading by window
+		# would not
+		if 'cf' in description or fi.coefficients is not None:
+			raise Exception("Density calibrated TIFF files can not be read by window")
+		self.n_slices = int(description.get('slices',
+		                    self.n_images // (self.n_channels*self.n_frames)))
+		self.frame_interval = fi.frameInterval
+		self.time_unit = description.get('tunit', 'sec')
+
+		self.file = RandomAccessFile(path, 'r')
+
+	def getNChannels(self):
+		return self.n_channels
+
+	def getNSlices(self):
+		return self.n_slices
+
+	def getNFrames(self):
+		return self.n_frames
+
+	def getStackIndex(self, channel, z, frame):
+		return ((frame - 1)*self.n_slices + (z - 1))*self.n_channels + channel
+
+	def rowOffset(self, index, row):
+		'''
+		arguments index: integer, 1-based stack index, row: integer
+		returns the file offset of the first pixel of row in image index
+		'''
+		if self.contiguous:
+			fi = self.infos[0]
+			return (fi.getOffset() + (index - 1)*(self.image_bytes +
+			        fi.gapBetweenImages) + row*self.row_bytes)
+
+		fi = self.infos[index - 1]
+		strips = fi.stripOffsets
+		if strips is not None and len(strips) > 1 and fi.rowsPerStrip > 0:
+			strip = row // fi.rowsPerStrip
+			return ((strips[strip] & 0xffffffffL) +
+			        (row % fi.rowsPerStrip)*self.row_bytes)
+		return fi.getOffset() + row*self.row_bytes
+
+	def readWindow(self, index, x0, y0, w, h):
+		'''
+		Reads the w*h window at x0, y0 of image index
+		arguments index: integer, 1-based stack index, x0, y0, w, h:
+		integers, a window inside the image
+		returns the pixel array of the window, as a byte, short or float
+		array like ImageStack.getPixels
+		'''
+		n_bytes = w*self.bytes_per_pixel
+		buf = zeros(n_bytes*h, 'b')
+		for row in range(h):
+			self.file.seek(self.rowOffset(index, y0 + row) +
+			               x0*self.bytes_per_pixel)
+			self.file.readFully(buf, row*n_bytes, n_bytes)
+
+		if self.bit_depth == 8:
+			return buf
+
+		data = ByteBuffer.wrap(buf).order(self.byte_order)
+		if self.bit_depth == 16:
+			pixels = zeros(w*h, 'h')
+			data.asShortBuffer().get(pixels)
+		else:
+			pixels = zeros(w*h, 'f')
+			data.asFloatBuffer().get(pixels)
+		return pixels
+
+	def close(self):
+		self.file.close()
+
+def measureWindowIntensities(reader, rois, indices):
+	'''
+	Like measureIntensities, but reads only the window covering the rois
+	of each image, through a TiffWindowReader
+	arguments reader: TiffWindowReader, rois: list of Rois, indices: list
+	of stack indices, as made by channelIndices
+	returns one list per roi, with its mean intensity in each image
+	'''
+	x0 = reader.width
+	y0 = reader.height
+	x1 = y1 = 0
+	for roi in rois:
+		bounds = roi.getBounds()
+		x0 = min(x0, max(0, bounds.x))
+		y0 = min(y0, max(0, bounds.y))
+		x1 = max(x1, min(reader.width, bounds.x + bounds.width))
+		y1 = max(y1, min(reader.height, bounds.y + bounds.height))
+	w = max(0, x1 - x0)
+	h = max(0, y1 - y0)
+
+	masks = [roiPixelIndices(roi, w, h, x0, y0) for roi in rois]
+
+	curves = [[] for roi in rois]
+	for index in indices:
+		pixels = reader.readWindow(index, x0, y0, w, h)
+		for mask, curve in zip(masks, curves):
+			curve.append(maskMean(pixels, mask, reader.bit_depth))
+
+	return curves
+
+def subtractBackground(curves):
+	'''
+	arguments curves: list of the FRAP, the normalizing and optionally a
+	background intensity curve
+	returns the FRAP and the normalizing curve, with the background
+	subtracted if there is one
+	'''
+	If = curves[0]
+	In = curves[1]
+
+	if len(curves) > 2:
+		If = [f - b for f, b in zip(If, curves[2])]
+		In = [n - b for n, b in zip(In, curves[2])]
+
+	return If, In
+
+# The normalizations of normalizeFRAP, and their names in the dialog
+normalization_keys = ['bleach_depth', 'double', 'full_scale']
+normalization_names = ['Bleach depth', 'Double (Phair)', 'Double, full scale']
+
+def referenceCorrection(In, bleach_frame):
+	'''
+	arguments In: list, background corrected intensities of the whole cell
+	or normalizing roi, bleach_frame: integer
+	returns the list pre_In/In, which corrects for the bleaching during
+	acquisition and can be shared by any number of FRAP curves
+	'''
+	pre_In = sum(In[:bleach_frame]) / float(bleach_frame)
+	return [pre_In / n for n in In]
+
+def normalizeFRAP(If, In, bleach_frame, method='bleach_depth',
+                  correction=None):
+	'''
+	Normalizes a background corrected FRAP curve, with whole curve list
+	operations
+	arguments If, In: lists, background corrected intensities of the FRAP
+	and the normalizing roi, bleach_frame: integer, method: one of
+	normalization_keys, correction: list as made by referenceCorrection,
+	computed from In if None
+	'bleach_depth' gives (If - If[bleach]) / (pre_If - If[bleach]) * pre_In/In,
+	0 right after the bleach and 1 before it.
+	'double' is the double normalization of Phair et al., If/pre_If *
+	pre_In/In, which keeps the bleach depth: 1 before the bleach.
+	'full_scale' is the double normalized curve scaled to be 0 right after
+	the bleach and 1 before it
+	returns the normalized curve
+	'''
+	if correction is None:
+		correction = referenceCorrection(In, bleach_frame)
+	pre_If = sum(If[:bleach_frame]) / float(bleach_frame)
+
+	if method == 'bleach_depth':
+		depth = pre_If - If[bleach_frame]
+		return [(f - If[bleach_frame]) / depth * c
+		        for f, c in zip(If, correction)]
+
+	double = [f / pre_If * c for f, c in zip(If, correction)]
+	if method == 'double':
+		return double
+
+	if method == 'full_scale':
+		pre = sum(double[:bleach_frame]) / float(bleach_frame)
+		return [(d - double[bleach_frame]) / (pre - double[bleach_frame])
+		        for d in double]
+
+	raise Exception("Unknown FRAP normalization: " + method)
+
+def offsetModels(models):
+	'''
+	arguments models: list of FRAP_model_keys
+	returns the list with 'exp', the only model without an offset, replaced
+	by 'exp_offset'
+	'''
+	offset_models = []
+	for model in models:
+		if model == 'exp':
+			model = 'exp_offset'
+		if model not in offset_models:
+			offset_models.append(model)
+	return offset_models
+
+def fitFRAP(If, In, frame_interval, autoFRAPflag=True, manual_FRAP_frame=0,
+            models=['exp'], criterion='AIC', executor=None,
+            normalization='bleach_depth'):
+	'''
+	Normalizes the FRAP curve to the pre bleach intensity and the
+	non-FRAPed area, and fits recovery models to the post bleach part of it
+	arguments If, In: lists of mean intensities in the FRAP and the norm
+	roi, frame_interval: float, autoFRAPflag: boolean, detect the bleach
+	frame as the minimal intensity, manual_FRAP_frame: integer, 0-indexed
+	bleach frame used if autoFRAPflag is False, models, criterion,
+	executor: as for fitModels, normalization: one of normalization_keys,
+	'double' fits 'exp' as 'exp_offset'
+	returns a dict with the 'bleach_frame', the normalized curve 'x', 'y',
+	the fitted part 'xtofit', 'ytofit', all model 'fits' as made by
+	fitModels, and the 'model', CurveFitter 'fitter', 'thalf' and
+	'mobile_fraction' of the best one
+	'''
+	n_slices = len(If)
+
+	#Automatic FRAP frame detection, the frame of minimal intensity
+	if autoFRAPflag:
+		bleach_frame = If.index( min( If ) )
+	else:
+		bleach_frame = manual_FRAP_frame
+
+	# Double normalized curves start at the bleach depth, not at 0, which
+	# the single exponential and its mobile fraction assume
+	if normalization == 'double':
+		models = offsetModels(models)
+
+	# Calculate normalized curve
+	normalized_curve = normalizeFRAP(If, In, bleach_frame, normalization)
+
+	x = [i * frame_interval for i in range( n_slices ) ]
+	y = normalized_curve
+
+	xtofit = [ i * frame_interval for i in range( n_slices - bleach_frame ) ]
+	ytofit = normalized_curve[ bleach_frame : n_slices ]
+
+	# Fitter
+	fits = fitModels(xtofit, ytofit, models, criterion, executor)
+	if len(fits) == 0:
+		raise Exception("None of the FRAP models could be fitted")
+	best = fits[0]
+
+	return {'bleach_frame':bleach_frame, 'x':x, 'y':y, 'xtofit':xtofit,
+	        'ytofit':ytofit, 'fits':fits, 'model':best['model'],
+	        'fitter':best['fitter'], 'thalf':best['thalf'],
+	        'mobile_fraction':best['mobile_fraction']}
+
+def scaledBesselSum(z):
+	'''
+	arguments z: float, z >= 0
+	returns exp(-z)*(I0(z) + I1(z)), with the modified Bessel functions I0
+	and I1 from the polynomial approximations of Abramowitz and Stegun
+	9.8.1-9.8.4, scaled so that large z do not overflow
+	'''
+	if z < 3.75:
+		t = (z/3.75)**2
+		i0 = 1 + t*(3.5156229 + t*(3.0899424 + t*(1.2067492 + t*(0.2659732 +
+		     t*(0.0360768 + t*0.0045813)))))
+		i1 = z*(0.5 + t*(0.87890594 + t*(0.51498869 + t*(0.15084934 +
+		     t*(0.02658733 + t*(0.00301532 + t*0.00032411))))))
+		return math.exp(-z)*(i0 + i1)
+
+	s = 3.75/z
+	i0 = 0.39894228 + s*(0.01328592 + s*(0.00225319 + s*(-0.00157565 +
+	     s*(0.00916281 + s*(-0.02057706 + s*(0.02635537 + s*(-0.01647633 +
+	     s*0.00392377)))))))
+	i1 = 0.39894228 + s*(-0.03988024 + s*(-0.00362018 + s*(0.00163801 +
+	     s*(-0.01031555 + s*(0.02282967 + s*(-0.02895312 + s*(0.01787654 -
+	     s*0.00420059)))))))
+	return (i0 + i1) / math.sqrt(z)
+
+class DoubleExponentialRecovery(UserFunction):
+	'''
+	y = a*(1-exp(-b*x)) + c*(1-exp(-d*x)) + e
+	'''
+	def userFunction(self, p, x):
+		return p[0]*(1 - math.exp(-p[1]*x)) + p[2]*(1 - math.exp(-p[3]*x)) + p[4]
+
+class SoumpasisRecovery(UserFunction):
+	'''
+	Soumpasis diffusion recovery of a circular bleach spot,
+	y = a*exp(-2*b/x)*(I0(2*b/x) + I1(2*b/x)) + c, where b = w^2/4D
+	'''
+	def userFunction(self, p, x):
+		if x <= 0:
+			return p[2]
+		return p[0]*scaledBesselSum(2*abs(p[1])/x) + p[2]
+
+# The recovery models of fitModels: name, number of parameters and the
+# recovered fraction at t = 0 and at t = infinity, from the parameters
+FRAP_models = {
+	'exp':        ('Single exponential', 2, lambda p: 0.0, lambda p: p[0]),
+	'exp_offset': ('Exponential with offset', 3, lambda p: p[2],
+	               lambda p: p[0] + p[2]),
+	'double_exp': ('Double exponential', 5, lambda p: p[4],
+	               lambda p: p[0] + p[2] + p[4]),
+	'soumpasis':  ('Soumpasis diffusion', 3, lambda p: p[2],
+	               lambda p: p[0] + p[2])}
+FRAP_model_keys = ['exp', 'exp_offset', 'double_exp', 'soumpasis']
+
+def recoveryGuess(x, y):
+	'''
+	arguments x, y: lists, a post bleach recovery curve
+	returns rough start values for the custom fits: the start and end
+	level of y and the time it takes to recover half way
+	'''
+	n_end = max(1, len(y)//10)
+	f0 = y[0]
+	f_inf = sum(y[-n_end:]) / float(n_end)
+	half = f0 + 0.5*(f_inf - f0)
+	for xi, yi in zip(x, y):
+		if (yi - half)*(f_inf - f0) >= 0 and xi > 0:
+			return f0, f_inf, xi
+	return f0, f_inf, x[-1]
+
+def halfRecoveryTime(fitter, params, f0, f_inf, t_max):
+	'''
+	Finds the time where the fitted curve has recovered half way from f0
+	to f_inf, by bisection
+	arguments fitter: CurveFitter, params: its parameters, f0, f_inf:
+	floats, t_max: float, a time where the curve has recovered beyond half
+	returns the half recovery time, or NaN if it is not found
+	'''
+	half = f0 + 0.5*(f_inf - f0)
+	sign = 1
+	if f_inf < f0:
+		sign = -1
+
+	for i in range(20):
+		if sign*(fitter.f(params, t_max) - half) >= 0:
+			break
+		t_max = 2*t_max
+	else:
+		return float('nan')
+
+	t_min = 0.0
+	for i in range(60):
+		t = 0.5*(t_min + t_max)
+		if sign*(fitter.f(params, t) - half) >= 0:
+			t_max = t
+		else:
+			t_min = t
+	return 0.5*(t_min + t_max)
+
+def fitModel(x, y, model, initial=None, restarts=None):
+	'''
+	Fits one of the FRAP_models to a recovery curve
+	arguments x, y: lists, the post bleach recovery curve, model: one of
+	FRAP_model_keys, initial: list of start parameters, guessed from the
+	curve if None, restarts: integer, CurveFitter restarts, its default if
+	None
+	returns a dict with the 'model', its 'name', the 'fitter', 'params',
+	'sse', 'aic', 'bic', 'thalf' and 'mobile_fraction'
+	'''
+	name, n_params, start, end = FRAP_models[model]
+	fitter = CurveFitter(x, y)
+	if restarts is not None:
+		fitter.setRestarts(restarts)
+
+	if model in ['exp', 'exp_offset']:
+		if initial is not None:
+			fitter.setInitialParameters(array(initial, 'd'))
+		if model == 'exp':
+			fitter.doFit(CurveFitter.EXP_RECOVERY_NOOFFSET)
+		else:
+			fitter.doFit(CurveFitter.EXP_RECOVERY)
+	else:
+		if initial is None:
+			f0, f_inf, t_half = recoveryGuess(x, y)
+			rate = math.log(2) / t_half
+			if model == 'double_exp':
+				initial = [0.5*(f_inf - f0), 3*rate, 0.5*(f_inf - f0),
+				           rate/3, f0]
+			else:
+				initial = [f_inf - f0, t_half, f0]
+		if model == 'double_exp':
+			function = DoubleExponentialRecovery()
+			formula = "y = a*(1-exp(-b*x)) + c*(1-exp(-d*x)) + e"
+		else:
+			function = SoumpasisRecovery()
+			formula = "y = a*exp(-2*b/x)*(I0(2*b/x) + I1(2*b/x)) + c"
+		fitter.doCustomFit(function, n_params, formula,
+		                   array(initial, 'd'), None, False)
+
+	params = fitter.getParams()
+	n = len(x)
+	sse = fitter.getSSE()
+	if not sse > 0:
+		sse = 1e-300
+
+	if model in ['exp', 'exp_offset']:
+		thalf = math.log(2) / params[1]
+	else:
+		thalf = halfRecoveryTime(fitter, params, start(params),
+		                         end(params), x[-1])
+
+	mobile_fraction = float('nan')
+	if start(params) != 1:
+		mobile_fraction = (end(params) - start(params)) / (1 - start(params))
+
+	return {'model':model, 'name':name, 'fitter':fitter,
+	        'params':list(params)[:n_params], 'sse':sse,
+	        'aic':n*math.log(sse/n) + 2*n_params,
+	        'bic':n*math.log(sse/n) + n_params*math.log(n),
+	        'thalf':thalf, 'mobile_fraction':mobile_fraction}
+
+class ModelFitTask(Callable):
+	'''
+	Fits one of the FRAP_models to a recovery curve
+	'''
+	def __init__(self, x, y, model):
+		self.x = x
+		self.y = y
+		self.model = model
+
+	def call(self):
+		return fitModel(self.x, self.y, self.model)
+
+def fitModels(x, y, models=['exp'], criterion='AIC', executor=None):
+	'''
+	Fits several recovery models to one curve, each on its own thread, and
+	ranks them
+	arguments x, y: lists, the post bleach recovery curve, models: list of
+	FRAP_model_keys, criterion: 'AIC' or 'BIC', executor: ExecutorService,
+	if None one is made when there is more than one model
+	returns a list of dicts with the 'model', its 'name', the 'fitter',
+	'params', 'sse', 'aic', 'bic', 'thalf' and 'mobile_fraction', best
+	model first. Models that could not be fitted are left out
+	'''
+	for model in models:
+		if model not in FRAP_models:
+			raise Exception("Unknown FRAP model: " + model)
+	tasks = [ModelFitTask(x, y, model) for model in models]
+
+	ownExecutor = executor is None and len(tasks) > 1
+	if ownExecutor:
+		executor = Executors.newFixedThreadPool(min(len(tasks), Prefs.getThreads()))
+
+	fits = []
+	if executor is None:
+		for task in tasks:
+			try:
+				fits.append(task.call())
+			except (Exception, Throwable), e:
+				IJ.log('Fit of ' + FRAP_models[task.model][0] + ' failed: ' + str(e))
+	else:
+		for task, future in zip(tasks, executor.invokeAll(tasks)):
+			try:
+				fits.append(future.get())
+			except (Exception, Throwable), e:
+				IJ.log('Fit of ' + FRAP_models[task.model][0] + ' failed: ' + str(e))
+
+	if ownExecutor:
+		executor.shutdown()
+
+	key = criterion.lower()
+	fits = [fit for fit in fits if not math.isnan(fit[key])]
+	fits.sort(key=lambda fit: fit[key])
+	return fits
+
+class BootstrapTask(Callable):
+	'''
+	Refits a model to resampled recovery curves, one per seed
+	'''
+	def __init__(self, x, fitted, residuals, model, initial, seeds):
+		self.x = x
+		self.fitted = fitted
+		self.residuals = residuals
+		self.model = model
+		self.initial = initial
+		self.seeds = seeds
+
+	def call(self):
+		estimates = []
+		for seed in self.seeds:
+			rng = random.Random(seed)
+			y = [f + rng.choice(self.residuals) for f in self.fitted]
+			try:
+				fit = fitModel(self.x, y, self.model, self.initial, restarts=0)
+			except (Exception, Throwable), e:
+				continue
+			estimates.append((fit['thalf'], fit['mobile_fraction']))
+		return estimates
+
+def percentile(values, q):
+	'''
+	arguments values: sorted list, q: float between 0 and 1
+	returns the q quantile of values, linearly interpolated
+	'''
+	if len(values) == 0:
+		return float('nan')
+	position = q*(len(values) - 1)
+	i = int(position)
+	if i + 1 >= len(values):
+		return values[-1]
+	return values[i] + (position - i)*(values[i+1] - values[i])
+
+def bootstrapFit(x, y, fit, n_bootstrap=1000, level=0.95, seed=0,
+                 executor=None):
+	'''
+	Residual bootstrap of a fitted recovery model: the residuals of the fit
+	are resampled onto the fitted curve and the model is refitted, warm
+	started from the point estimate, n_bootstrap times in parallel.
+	Replicate i uses the seed seed+i, so the intervals do not depend on the
+	number of threads
+	arguments x, y: lists, the fitted recovery curve, fit: dict as made by
+	fitModel, n_bootstrap: integer, level: float, confidence level, seed:
+	integer, executor: ExecutorService, one is made if None
+	returns a dict with the percentile confidence intervals 'thalf_ci' and
+	'mobile_fraction_ci' as (low, high) tuples, and 'n_bootstrap', the
+	number of refits that converged
+	'''
+	fitter = fit['fitter']
+	params = fitter.getParams()
+	fitted = [fitter.f(params, xi) for xi in x]
+	residuals = [yi - fi for yi, fi in zip(y, fitted)]
+
+	ownExecutor = executor is None
+	if ownExecutor:
+		executor = Executors.newFixedThreadPool(Prefs.getThreads())
+
+	n_tasks = max(1, min(4*Prefs.getThreads(), n_bootstrap))
+	edges = [n_bootstrap*k//n_tasks for k in range(n_tasks+1)]
+	tasks = [BootstrapTask(x, fitted, residuals, fit['model'], fit['params'],
+	                       range(seed + edges[k], seed + edges[k+1]))
+	         for k in range(n_tasks)]
+	estimates = []
+	for future in executor.invokeAll(tasks):
+		estimates += future.get()
+
+	if ownExecutor:
+		executor.shutdown()
+
+	alpha = 0.5*(1 - level)
+	intervals = {'n_bootstrap':len(estimates)}
+	for key, column in [('thalf_ci', 0), ('mobile_fraction_ci', 1)]:
+		values = sorted(e[column] for e in estimates if not math.isnan(e[column]))
+		intervals[key] = (percentile(values, alpha), percentile(values, 1 - alpha))
+	return intervals
+
+def solveSmall(M, v):
+	'''
+	arguments M: 1x1 or 2x2 matrix as nested lists, v: list
+	returns the solution x of M x = v
+	'''
+	if len(v) == 1:
+		return [v[0] / M[0][0]]
+	det = M[0][0]*M[1][1] - M[0][1]*M[1][0]
+	return [(M[1][1]*v[0] - M[0][1]*v[1]) / det,
+	        (M[0][0]*v[1] - M[1][0]*v[0]) / det]
+
+def globalRecoveryFit(curves, offsetFlag=False, max_iterations=200,
+                      tolerance=1e-10):
+	'''
+	Global fit of y_j = a_j*(1-exp(-b*t)) (+ c_j with offsetFlag) to the
+	recovery curves of many cells, with one rate b shared by all of them and
+	the amplitude a_j (and offset c_j) of each cell free, by
+	Levenberg-Marquardt.
+	Each residual only depends on b and on the parameters of its own cell,
+	so the Jacobian is arrow shaped. Its normal equations are solved by
+	eliminating the small per cell blocks (Schur complement), which makes
+	an iteration cost time linear in the number of cells.
+	arguments curves: list of (x, y) tuples, post bleach recovery curves as
+	fitted by fitFRAP, offsetFlag: boolean, max_iterations: integer,
+	tolerance: float, relative change in SSE at which the fit stops
+	returns a dict with the shared 'rate', its standard error 'rate_se',
+	'thalf', the per cell 'amplitudes', 'offsets' and 'mobile_fractions',
+	the 'sse' and the number of 'iterations'
+	'''
+	n_local = 1
+	if offsetFlag:
+		n_local = 2
+
+	for x, y in curves:
+		if len(x) < 2:
+			raise Exception("The global FRAP fit needs at least 2 post "
+			                "bleach points in every curve")
+
+	# Start from separate fits of each cell, with the median rate
+	starts = []
+	for x, y in curves:
+		dt = x[1] - x[0]
+		b_min = 0.1 / max(x[-1], dt)
+		b_max = 10.0 / dt
+		rates = [b_min * (b_max/b_min)**(k/31.0) for k in range(32)]
+		start = fitRecoveryGrid(y, x, rates, recoveryBasis(x, rates,
+		                        offsetFlag), offsetFlag)
+		if start is None:
+			raise Exception("A curve of the global FRAP fit can not be fitted")
+		starts.append(start)
+	rates = sorted(start[1] for start in starts)
+	b = rates[len(rates)//2]
+	local = [[start[0], start[2]][:n_local] for start in starts]
+
+	def sumOfSquares(b, local):
+		sse = 0.0
+		for (x, y), p in zip(curves, local):
+			c = 0.0
+			if offsetFlag:
+				c = p[1]
+			sse += sum((yi - p[0]*(1 - math.exp(-b*xi)) - c)**2
+			           for xi, yi in zip(x, y))
+		return sse
+
+	sse = sumOfSquares(b, local)
+	damping = 1e-3
+	iterations = 0
+	S = float('nan')
+
+	for iterations in range(1, max_iterations+1):
+		# Blocks of the normal equations: V_j per cell, U for the rate, W_j
+		# coupling them, and the right hand sides e_j and e_b
+		U = 0.0
+		e_b = 0.0
+		blocks = []
+		for (x, y), p in zip(curves, local):
+			c = 0.0
+			if offsetFlag:
+				c = p[1]
+			V = [[0.0]*n_local for k in range(n_local)]
+			W = [0.0]*n_local
+			e = [0.0]*n_local
+			for xi, yi in zip(x, y):
+				decay = math.exp(-b*xi)
+				r = yi - p[0]*(1 - decay) - c
+				g = p[0]*xi*decay
+				d = [1 - decay, 1.0][:n_local]
+				for k in range(n_local):
+					W[k] += d[k]*g
+					e[k] += d[k]*r
+					for l in range(n_local):
+						V[k][l] += d[k]*d[l]
+				U += g*g
+				e_b += g*r
+			blocks.append((V, W, e))
+
+		# Undamped Schur complement, for the standard error of the rate
+		S = U
+		for V, W, e in blocks:
+			S -= sum(map(mul, W, solveSmall(V, W)))
+
+		while True:
+			S_damped = U*(1 + damping)
+			rhs = e_b
+			solved = []
+			for V, W, e in blocks:
+				V_damped = [[V[k][l]*(1 + damping*(k == l)) for l in range(n_local)]
+				            for k in range(n_local)]
+				V_W = solveSmall(V_damped, W)
+				V_e = solveSmall(V_damped, e)
+				S_damped -= sum(map(mul, W, V_W))
+				rhs -= sum(map(mul, W, V_e))
+				solved.append((V_W, V_e))
+
+			step_b = rhs / S_damped
+			new_b = b + step_b
+			new_local = [[pk + ek - wk*step_b for pk, ek, wk in zip(p, V_e, V_W)]
+			             for p, (V_W, V_e) in zip(local, solved)]
+			new_sse = float('inf')
+			if new_b > 0:
+				new_sse = sumOfSquares(new_b, new_local)
+
+			if new_sse <= sse:
+				damping = max(damping/10, 1e-12)
+				break
+			damping *= 10
+			if damping > 1e12:
+				new_sse = sse
+				break
+
+		if new_sse == sse or (sse - new_sse) <= tolerance*sse:
+			if new_sse < sse:
+				b, local, sse = new_b, new_local, new_sse
+			break
+		b, local, sse = new_b, new_local, new_sse
+
+	n = sum(len(x) for x, y in curves)
+	n_params = 1 + n_local*len(curves)
+	rate_se = float('nan')
+	if n > n_params and S > 0:
+		rate_se = math.sqrt(sse / (n - n_params) / S)
+
+	amplitudes = [p[0] for p in local]
+	offsets = [0.0]*len(local)
+	if offsetFlag:
+		offsets = [p[1] for p in local]
+	mobile_fractions = [a / (1 - c) if c != 1 else float('nan')
+	                    for a, c in zip(amplitudes, offsets)]
+
+	return {'rate':b, 'rate_se':rate_se, 'thalf':math.log(2) / b,
+	        'amplitudes':amplitudes, 'offsets':offsets,
+	        'mobile_fractions':mobile_fractions, 'sse':sse,
+	        'iterations':iterations}
+
+def addBootstrapValues(rt, result):
+	'''
+	Adds the bootstrap confidence intervals of result to the current row
+	of rt, with the same column names in every FRAP table
+	arguments rt: ResultsTable, result: dict as made by fitFRAP, updated
+	with bootstrapFit
+	'''
+	rt.addValue('T.half.CI.low', result['thalf_ci'][0])
+	rt.addValue('T.half.CI.high', result['thalf_ci'][1])
+	rt.addValue('Mobile.fraction.CI.low', result['mobile_fraction_ci'][0])
+	rt.addValue('Mobile.fraction.CI.high', result['mobile_fraction_ci'][1])
+
+def recoveryBasis(t, rates, offsetFlag=False):
+	'''
+	Precomputes the recovery curves 1-exp(-b*t) for every rate b, shared by
+	all the pixels fitted with fitRecoveryGrid
+	arguments t: list of post bleach times, rates: list of rates b,
+	offsetFlag: boolean, center the sums for a fit with offset
+	returns a list of (u, Su, Suu) tuples, u the curve, Su its sum and Suu
+	its (centered) sum of squares
+	'''
+	n = float(len(t))
+	basis = []
+	for b in rates:
+		u = [1 - math.exp(-b*ti) for ti in t]
+		Su = sum(u)
+		Suu = sum(map(mul, u, u))
+		if offsetFlag:
+			Suu -= Su*Su/n
+		basis.append((u, Su, Suu))
+	return basis
+
+def fitRecoveryGrid(y, t, rates, basis, offsetFlag=False):
+	'''
+	Least squares fit of y = a*(1-exp(-b*t)) (+ c with offsetFlag) by a
+	search over the rates, where a and c have closed forms for each b,
+	refined by a parabola through the best rate and its neighbours
+	arguments y: list of normalized intensities, t: list of times, rates:
+	log spaced list of rates, basis: as made by recoveryBasis,
+	offsetFlag: boolean
+	returns a, b, c and R squared of the fit, or None if the curve is too
+	short for it, e.g. a single post bleach point
+	'''
+	n = float(len(y))
+	Sy = sum(y)
+	Syy = sum(map(mul, y, y))
+	SStot = Syy - Sy*Sy/n
+
+	# Without offset the sums are not centered
+	Sy_c = 0.0
+	if offsetFlag:
+		Sy_c = Sy
+
+	# A recovery curve that is 0 (or constant, with offset) at every time
+	# point can not be fitted
+	sse = []
+	for u, Su, Suu in basis:
+		if not Suu > 0:
+			sse.append(float('inf'))
+			continue
+		Suy = sum(map(mul, u, y)) - Su*Sy_c/n
+		sse.append(Syy - Sy_c*Sy_c/n - Suy*Suy/Suu)
+
+	k = sse.index(min(sse))
+	if sse[k] == float('inf'):
+		return None
+	log_b = math.log(rates[k])
+	if (0 < k < len(rates) - 1 and sse[k-1] < float('inf') and
+	    sse[k+1] < float('inf')):
+		curvature = sse[k-1] - 2*sse[k] + sse[k+1]
+		if curvature > 0:
+			step = math.log(rates[k+1]) - log_b
+			log_b += 0.5*step*(sse[k-1] - sse[k+1])/curvature
+
+	b = math.exp(log_b)
+	u, Su, Suu = recoveryBasis(t, [b], offsetFlag)[0]
+	if not Suu > 0:
+		return None
+	Suy = sum(map(mul, u, y)) - Su*Sy_c/n
+	a = Suy/Suu
+	c = 0.0
+	if offsetFlag:
+		c = (Sy - a*Su)/n
+
+	residuals = [yi - a*ui - c for yi, ui in zip(y, u)]
+	r2 = float('nan')
+	if SStot > 0:
+		r2 = 1 - sum(map(mul, residuals, residuals))/SStot
+
+	return a, b, c, r2
+
+class RecoveryMapTask(Callable):
+	'''
+	Fits the recovery curves of the pixels in one tile of the bleach roi
+	'''
+	def __init__(self, curves, t, rates, basis, offsetFlag):
+		self.curves = curves
+		self.t = t
+		self.rates = rates
+		self.basis = basis
+		self.offsetFlag = offsetFlag
+
+	def call(self):
+		fits = []
+		for y in self.curves:
+			if y is None:
+				fits.append(None)
+			else:
+				fits.append(fitRecoveryGrid(y, self.t, self.rates, self.basis,
+				                            self.offsetFlag))
+		return fits
+
+def recoveryMaps(stack, roi, In, bleach_frame, frame_interval, calibration,
+                 offsetFlag=False, n_rates=64, executor=None,
+                 normalization='bleach_depth'):
+	'''
+	Fits the FRAP recovery of every pixel in roi, normalized as in fitFRAP
+	with the normalizing curve In, as EXP_RECOVERY_NOOFFSET or, with
+	offsetFlag, EXP_RECOVERY. All pixels share the time axis, so the
+	recovery curves of a grid of rates are computed once, and the pixels
+	are fitted in parallel, one tile of rows per task
+	arguments stack: ImageStack of the channel, roi: Roi, In: list, the
+	normalizing curve, bleach_frame: integer, frame_interval: float,
+	calibration: Calibration, offsetFlag: boolean, n_rates: integer,
+	number of rates searched, executor: ExecutorService or None,
+	normalization: one of normalization_keys, 'double' always fits with
+	offset
+	returns a float ImagePlus of the roi bounding box with the slices
+	T.half, Mobile.fraction, Offset (with offsetFlag) and R2, NaN outside
+	the roi and where the fit is undefined
+	'''
+	n_slices = len(In)
+	bounds = roi.getBounds()
+	bit_depth = stack.getBitDepth()
+	ctable = None
+	if calibration.calibrated():
+		ctable = calibration.getCTable()
+
+	indices = roiPixelIndices(roi, stack.getWidth(), stack.getHeight())
+	frames = [list(maskValues(stack.getPixels(i+1), indices, bit_depth, ctable))
+	          for i in range(n_slices)]
+
+	correction = referenceCorrection(In, bleach_frame)
+
+	# Double normalized curves start at the bleach depth, as in fitFRAP
+	if normalization == 'double':
+		offsetFlag = True
+
+	# Normalized post bleach curve of every pixel, None where the pixel is
+	# not bleached, or dark before the bleach, and can not be normalized
+	curves = []
+	for series in zip(*frames):
+		try:
+			curves.append(normalizeFRAP(series, In, bleach_frame,
+			                            normalization,
+			                            correction)[bleach_frame:])
+		except ZeroDivisionError:
+			curves.append(None)
+
+	t = [i * frame_interval for i in range(n_slices - bleach_frame)]
+	b_min = 0.1 / max(t[-1], frame_interval)
+	b_max = 10.0 / frame_interval
+	rates = [b_min * (b_max/b_min)**(k/(n_rates - 1.0)) for k in range(n_rates)]
+	basis = recoveryBasis(t, rates, offsetFlag)
+
+	ownExecutor = executor is None
+	if ownExecutor:
+		executor = Executors.newFixedThreadPool(Prefs.getThreads())
+
+	n_tasks = max(1, min(4*Prefs.getThreads(), len(curves)))
+	edges = [len(curves)*k//n_tasks for k in range(n_tasks+1)]
+	tasks = [RecoveryMapTask(curves[edges[k]:edges[k+1]], t, rates, basis,
+	                         offsetFlag) for k in range(n_tasks)]
+	fits = []
+	for future in executor.invokeAll(tasks):
+		fits += future.get()
+
+	if ownExecutor:
+		executor.shutdown()
+
+	labels = ['T.half', 'Mobile.fraction', 'R2']
+	if offsetFlag:
+		labels = ['T.half', 'Mobile.fraction', 'Offset', 'R2']
+	maps = [[float('nan')] * (bounds.width*bounds.height) for label in labels]
+
+	for index, fit in zip(indices, fits):
+		if fit is None:
+			continue
+		a, b, c, r2 = fit
+		pixel = ((index // stack.getWidth() - bounds.y) * bounds.width +
+		         index % stack.getWidth() - bounds.x)
+		values = [math.log(2) / b, a, r2]
+		if offsetFlag:
+			# mobile fraction (f_inf - f_0)/(1 - f_0) of the offset curve
+			mobile_fraction = float('nan')
+			if c != 1:
+				mobile_fraction = a / (1 - c)
+			values = [math.log(2) / b, mobile_fraction, c, r2]
+		for parameter_map, value in zip(maps, values):
+			parameter_map[pixel] = value
+
+	map_stack = ImageStack(bounds.width, bounds.height)
+	for label, parameter_map in zip(labels, maps):
+		map_stack.addSlice(label, FloatProcessor(bounds.width, bounds.height,
+		                                         parameter_map))
+
+	map_imp = ImagePlus("Recovery maps", map_stack)
+	map_imp.setCalibration(calibration)
+	return map_imp
+
+def isBackgroundRoi(roi):
+	'''
+	arguments roi: Roi
+	returns True if the roi is named Background or Bg (not case sensitive)
+	'''
+	name = (roi.getName() or '').lower()
+	return name.startswith('background') or name.startswith('bg')
+
+def analysisRois(rois):
+	'''
+	arguments rois: list of Rois, the FRAP and the normalizing roi first
+	returns the FRAP and the normalizing roi, and the first of the other
+	rois named as background by isBackgroundRoi, if there is one
+	'''
+	return list(rois[:2]) + [roi for roi in rois[2:] if isBackgroundRoi(roi)][:1]
+
+def spotRois(rois):
+	'''
+	Finds the rois of a multi-spot FRAP experiment by their names: every
+	roi whose name starts with FRAP is a bleach spot, the one starting with
+	Ref or Norm is the normalizing roi and an optional one starting with
+	Background or Bg is the background (not case sensitive)
+	arguments rois: list of Rois
+	returns the list of FRAP rois, the normalizing roi and the background
+	roi or None, or None if no roi is named FRAP
+	'''
+	frap_rois = []
+	roi_norm = None
+	roi_bg = None
+	for roi in rois:
+		name = (roi.getName() or '').lower()
+		if name.startswith('frap'):
+			frap_rois.append(roi)
+		elif name.startswith('ref') or name.startswith('norm'):
+			roi_norm = roi
+		elif isBackgroundRoi(roi):
+			roi_bg = roi
+
+	if len(frap_rois) == 0:
+		return None
+	if roi_norm is None:
+		raise Exception("Multi-spot FRAP needs a roi named Ref or Norm")
+	return frap_rois, roi_norm, roi_bg
+
+class SpotFitTask(Callable):
+	'''
+	Runs fitFRAP, and bootstrapFit if asked for, on the curve of one spot
+	'''
+	def __init__(self, name, curves, frame_interval, autoFRAPflag,
+	             manual_FRAP_frame, models, criterion, normalization,
+	             n_bootstrap, model_executor):
+		self.name = name
+		self.curves = curves
+		self.frame_interval = frame_interval
+		self.autoFRAPflag = autoFRAPflag
+		self.manual_FRAP_frame = manual_FRAP_frame
+		self.models = models
+		self.criterion = criterion
+		self.normalization = normalization
+		self.n_bootstrap = n_bootstrap
+		self.model_executor = model_executor
+
+	def call(self):
+		If, In = subtractBackground(self.curves)
+		result = fitFRAP(If, In, self.frame_interval, self.autoFRAPflag,
+		                 self.manual_FRAP_frame, self.models, self.criterion,
+		                 self.model_executor, self.normalization)
+		if self.n_bootstrap > 0:
+			result.update(bootstrapFit(result['xtofit'], result['ytofit'],
+			                           result['fits'][0], self.n_bootstrap,
+			                           executor=self.model_executor))
+		result['spot'] = self.name
+		return result
+
+def multiSpotFRAP(measure, rois, frame_interval, autoFRAPflag=True,
+                  manual_FRAP_frame=0, models=['exp'], criterion='AIC',
+                  normalization='bleach_depth', n_bootstrap=0, executor=None,
+                  model_executor=None):
+	'''
+	Analyzes every bleach spot found by spotRois as its own FRAP curve,
+	with the shared normalizing and background roi. All curves are
+	extracted in one pass over the stack, and the spots are fitted in
+	parallel if an executor is given
+	arguments measure: function taking a list of rois and returning their
+	intensity curves, as measureIntensities or measureWindowIntensities,
+	rois: list of named Rois, frame_interval: float, executor:
+	ExecutorService for the spots, None fits them one after the other,
+	model_executor: ExecutorService for the models and bootstrap refits of
+	a spot, it must not be the spot executor, the rest as for fitFRAP and
+	bootstrapFit
+	returns a list of dicts as made by fitFRAP, one per spot that could be
+	fitted, with the roi name as 'spot'
+	'''
+	frap_rois, roi_norm, roi_bg = spotRois(rois)
+	shared_rois = [roi_norm]
+	if roi_bg is not None:
+		shared_rois.append(roi_bg)
+
+	curves = measure(frap_rois + shared_rois)
+	shared_curves = curves[len(frap_rois):]
+
+	tasks = []
+	for i, roi in enumerate(frap_rois):
+		name = roi.getName()
+		tasks.append(SpotFitTask(name, [curves[i]] + shared_curves,
+		                         frame_interval, autoFRAPflag,
+		                         manual_FRAP_frame, models, criterion,
+		                         normalization, n_bootstrap, model_executor))
+
+	if executor is not None:
+		futures = executor.invokeAll(tasks)
+
+	results = []
+	for i, task in enumerate(tasks):
+		try:
+			if executor is not None:
+				results.append(futures[i].get())
+			else:
+				results.append(task.call())
+		except (Exception, Throwable), e:
+			IJ.log('Fit of spot ' + task.name + ' failed: ' + str(e))
+
+	return results
+
+def addFitValues(rt, result, n_bootstrap=0):
+	'''
+	Adds the fitted FRAP parameters of result to the current row of rt,
+	with the same column names in every FRAP table
+	arguments rt: ResultsTable, result: dict as made by fitFRAP,
+	n_bootstrap: integer, if above 0 the confidence intervals are added
+	'''
+	rt.addValue('FRAP.frame', result['bleach_frame']+1)
+	rt.addValue('Model', FRAP_models[result['model']][0])
+	rt.addValue('T.half', result['thalf'])
+	rt.addValue('Mobile.fraction', result['mobile_fraction'])
+	if n_bootstrap > 0:
+		addBootstrapValues(rt, result)
+
+def interactiveFRAP():
+	'''
+	Analyzes the current image with the first ROIs of the RoiManager,
+	and shows the FRAP curve, the fit and the results table. If rois are
+	named FRAP, every one of them is analyzed by multiSpotFRAP instead
+	'''
+	# Get ROIs
+	roi_manager = RoiManager.getInstance()
+	roi_list    = roi_manager.getRoisAsArray()
+
+	# We assume first one is FRAP roi, the 2nd one is normalizing roi, and
+	# an optional one named Background is background
+	rois        = analysisRois(roi_list)
+
+	# Get current image plus and image processor
+	current_imp  = WindowManager.getCurrentImage()
+	# Pass current imp through the FRAPsetupDialog
+	setup = FRAPsetupDialog(current_imp)
+	if setup is None:
+		return
+	(current_imp, max_frame, manual_FRAP_frame, autoFRAPflag, mapFlag,
+	 mapOffsetFlag, models, criterion, n_bootstrap, normalization) = setup
+	stack        = current_imp.getImageStack()
+	calibration  = current_imp.getCalibration()
+	title        = current_imp.getTitle()
+	# Specify up to what frame to fit and plot, set in FRAPsetupDialog
+	n_slices = max_frame
+
+	if spotRois(roi_list) is not None:
+		measure = lambda rois: measureIntensities(stack, rois, n_slices,
+		                                          calibration)
+		# The models of a spot are fitted on their own pool, a spot task
+		# waiting for its fits must not hold up the pool they run on
+		model_executor = None
+		if len(models) > 1 or n_bootstrap > 0:
+			model_executor = Executors.newFixedThreadPool(Prefs.getThreads())
+		executor = Executors.newFixedThreadPool(Prefs.getThreads())
+		try:
+			results = multiSpotFRAP(measure, roi_list,
+			                        calibration.frameInterval, autoFRAPflag,
+			                        manual_FRAP_frame, models, criterion,
+			                        normalization, n_bootstrap, executor,
+			                        model_executor)
+		finally:
+			executor.shutdown()
+			if model_executor is not None:
+				model_executor.shutdown()
+		IJ.log('Fitted %d FRAP spots in %s' % (len(results), title))
+
+		rt=ResultsTable()
+		for result in results:
+			rt.incrementCounter()
+			rt.addValue('Spot', result['spot'])
+			addFitValues(rt, result, n_bootstrap)
+		rt.disableRowLabels()
+		rt.show(title + '_spots')
+		if mapFlag:
+			IJ.log('Recovery maps are only made for a single FRAP roi, '
+			       'skipped for the spots')
+		return
+
+	# Collect intensity values
+	If, In = subtractBackground(measureIntensities(stack, rois, n_slices,
+	                                               calibration))
+
+	# Gather image parameters
+	frame_interval = calibration.frameInterval
+	time_units = calibration.getTimeUnit()
+	IJ.log('For image ' + title )
+	IJ.log('Time interval is ' + str(frame_interval) + ' ' + time_units)
+
+	result = fitFRAP(If, In, frame_interval, autoFRAPflag, manual_FRAP_frame,
+	                 models, criterion, normalization=normalization)
+	bleach_frame = result['bleach_frame']
+	x = result['x']
+	y = result['y']
+	xtofit = result['xtofit']
+	ytofit = result['ytofit']
+	fitter = result['fitter']
+
+	if n_bootstrap > 0:
+		result.update(bootstrapFit(xtofit, ytofit, result['fits'][0],
+		                           n_bootstrap))
+	IJ.log('FRAP frame is ' + str(bleach_frame+1) + ' at t = ' + str(bleach_frame * frame_interval) + ' ' + time_units )
+	if len(result['fits']) > 1:
+		IJ.log('Fitted models, ranked by ' + criterion + ':')
+		for fit in result['fits']:
+			IJ.log('  %s: AIC = %.2f, BIC = %.2f, T.half = %.2f %s, mobile fraction = %.3f'
+			       % (fit['name'], fit['aic'], fit['bic'], fit['thalf'],
+			          time_units, fit['mobile_fraction']))
+	IJ.log("Fit FRAP curve by " + fitter.getFormula() )
+	IJ.log( fitter.getResultString() )
+
+	# Overlay fit curve, with oversampling (for plot)
+	xfit = [ (t / 10.0  + bleach_frame) * frame_interval for t in range(10 * len(xtofit) ) ]
+	yfit = []
+	for xt in xfit:
+		yfit.append( fitter.f( fitter.getParams(), xt - xfit[0]) )
+
+	plot = Plot("Normalized FRAP curve for " + current_imp.getTitle(), "Time ("+time_units+')', "NU", [], [])
+	plot.setLimits(0, max(x), 0, 1.2 );
+	plot.setLineWidth(2)
+
+	plot.setColor(Color.BLACK)
+	plot.addPoints(x, y, Plot.LINE)
+	plot.addPoints(x,y,PlotWindow.X);
+
+	plot.setColor(Color.RED)
+	plot.addPoints(xfit, yfit, Plot.LINE)
+
+	plot.setColor(Color.black);
+	plot_window =  plot.show()
+
+	# Output FRAP parameters
+	str1 = ('Half-recovery time = %.2f ' + time_units) % result['thalf']
+	IJ.log( str1 )
+	str2 = "Mobile fraction = %.1f %%" % (100 * result['mobile_fraction'])
+	IJ.log( str2 )
+	if n_bootstrap > 0:
+		IJ.log(('95%% CI of half-recovery time = %.2f - %.2f ' + time_units)
+		       % result['thalf_ci'])
+		IJ.log("95%% CI of mobile fraction = %.1f - %.1f %%"
+		       % (100 * result['mobile_fraction_ci'][0],
+		          100 * result['mobile_fraction_ci'][1]))
+
+	IJ.run("Clear Results")
+
+	rt=ResultsTable()
+
+	for i in range(len(xtofit)):
+		rt.incrementCounter()
+		rt.addValue('Time.pb',xtofit[i])
+		rt.addValue("Norm.int",ytofit[i])
+		rt.addValue("Frame.interval",frame_interval)
+		if n_bootstrap > 0:
+			addBootstrapValues(rt, result)
+	rt.disableRowLabels()
+	rt.show(title)
+
+	if mapFlag:
+		map_imp = recoveryMaps(stack, rois[0], In, bleach_frame,
+		                       frame_interval, calibration, mapOffsetFlag,
+		                       normalization=normalization)
+		map_imp.setTitle(title + "_recovery_maps")
+		map_imp.show()
+
+def findRoiSet(movie_path):
+	'''
+	arguments movie_path: string, path to a movie
+	returns the path of the ROI set zip saved next to the movie, as
+	movie.zip or movie_RoiSet.zip, or None if there is none
+	'''
+	base = os.path.splitext(movie_path)[0]
+	for roi_path in [base + '.zip', base + '_RoiSet.zip']:
+		if os.path.isfile(roi_path):
+			return roi_path
+	return None
+
+def readRoiSet(path):
+	'''
+	Reads a ROI set saved by the RoiManager, without needing a RoiManager
+	arguments path: string, path to the zip file
+	returns a list of the Rois, in the order they were saved
+	'''
+	rois = []
+	zip_file = ZipFile(path)
+	entries = zip_file.entries()
+	buf = zeros(8192, 'b')
+
+	while entries.hasMoreElements():
+		entry = entries.nextElement()
+		if not entry.getName().endswith('.roi'):
+			continue
+
+		stream = zip_file.getInputStream(entry)
+		roi_bytes = ByteArrayOutputStream()
+		n = stream.read(buf)
+		while n > 0:
+			roi_bytes.write(buf, 0, n)
+			n = stream.read(buf)
+		stream.close()
+
+		rois.append(RoiDecoder(roi_bytes.toByteArray(), entry.getName()).getRoi())
+
+	zip_file.close()
+	return rois
+
+class FRAPTask(Callable):
+	'''
+	Runs the FRAP analysis on one movie of a batch, with the first two ROIs
+	of its ROI set as FRAP and normalizing roi and one named Background, if
+	there is one, as background roi, or
+	with every roi named FRAP as a spot of multiSpotFRAP. Returns a list of
+	results, one per spot
+	'''
+	def __init__(self, movie_path, roi_path, channel, max_frame,
+	             autoFRAPflag, manual_FRAP_frame, default_interval,
+	             models=['exp'], criterion='AIC', model_executor=None,
+	             n_bootstrap=0, normalization='bleach_depth'):
+		self.movie_path = movie_path
+		self.roi_path = roi_path
+		self.channel = channel
+		self.max_frame = max_frame
+		self.autoFRAPflag = autoFRAPflag
+		self.manual_FRAP_frame = manual_FRAP_frame
+		self.default_interval = default_interval
+		self.models = models
+		self.criterion = criterion
+		self.model_executor = model_executor
+		self.n_bootstrap = n_bootstrap
+		self.normalization = normalization
+
+	def call(self):
+		rois = readRoiSet(self.roi_path)
+		if len(rois) < 2:
+			raise Exception("Need a FRAP and a normalizing roi in " + self.roi_path)
+
+		# Uncompressed TIFFs are read by window, only the rows under the
+		# rois, anything else is opened as a whole
+		try:
+			reader = TiffWindowReader(self.movie_path)
+		except (Exception, Throwable), e:
+			reader = None
+
+		if reader is not None:
+			title = reader.title
+			frame_interval = reader.frame_interval
+			time_units = reader.time_unit
+			indices = channelIndices(reader, self.channel, self.max_frame)
+			measure = lambda rois: measureWindowIntensities(reader, rois,
+			                                                indices)
+		else:
+			imp = IJ.openImage(self.movie_path)
+			if imp is None:
+				raise Exception("Could not open " + self.movie_path)
+
+			title = imp.getTitle()
+			calibration = imp.getCalibration()
+			frame_interval = calibration.frameInterval
+			time_units = calibration.getTimeUnit()
+
+			imp = channelSelector(imp, self.channel, self.max_frame)
+			stack = imp.getImageStack()
+			n_slices = imp.getStackSize()
+			measure = lambda rois: measureIntensities(stack, rois, n_slices,
+			                                          calibration)
+
+		if not frame_interval > 0:
+			frame_interval = self.default_interval
+
+		try:
+			# The movies already run in parallel, so the spots of one are
+			# fitted one after the other, sharing the batch model pool
+			if spotRois(rois) is not None:
+				results = multiSpotFRAP(measure, rois, frame_interval,
+				                        self.autoFRAPflag,
+				                        self.manual_FRAP_frame, self.models,
+				                        self.criterion, self.normalization,
+				                        self.n_bootstrap,
+				                        model_executor=self.model_executor)
+			else:
+				If, In = subtractBackground(measure(analysisRois(rois)))
+				result = fitFRAP(If, In, frame_interval, self.autoFRAPflag,
+				                 self.manual_FRAP_frame, self.models,
+				                 self.criterion, self.model_executor,
+				                 self.normalization)
+				if self.n_bootstrap > 0:
+					result.update(bootstrapFit(result['xtofit'],
+					                           result['ytofit'],
+					                           result['fits'][0],
+					                           self.n_bootstrap,
+					                           executor=self.model_executor))
+				result['spot'] = rois[0].getName()
+				results = [result]
+		finally:
+			if reader is not None:
+				reader.close()
+
+		for result in results:
+			result['title'] = title
+			result['frame_interval'] = frame_interval
+			result['time_units'] = time_units
+		return results
+
+def batchFRAP(folder, channel=1, max_frame=105, autoFRAPflag=True,
+              manual_FRAP_frame=0, default_interval=1.57, models=['exp'],
+              criterion='AIC', n_bootstrap=0, normalization='bleach_depth',
+              global_model=''):
+	'''
+	Analyzes every movie in folder that has a ROI set, one movie per thread,
+	and saves one row per movie, or per spot, to FRAP_results.csv in folder
+	arguments folder: string, channel: integer, max_frame: integer, number
+	of frames to analyze, autoFRAPflag: boolean, manual_FRAP_frame: integer,
+	0-indexed bleach frame, default_interval: float, frame interval for
+	movies without one, models, criterion: as for fitModels, n_bootstrap:
+	integer, number of bootstrap refits for the confidence intervals,
+	normalization: one of normalization_keys, global_model: 'exp' or
+	'exp_offset' for a global fit of all movies with a shared rate, saved
+	to FRAP_global_results.csv, '' for none
+	returns the ResultsTable
+	'''
+	if global_model not in ['', 'exp', 'exp_offset']:
+		raise Exception("Unknown global FRAP model: " + global_model +
+		                ", use exp or exp_offset")
+	if criterion not in ['AIC', 'BIC']:
+		raise Exception("Unknown model selection criterion: " + criterion +
+		                ", use AIC or BIC")
+	if normalization not in normalization_keys:
+		raise Exception("Unknown FRAP normalization: " + normalization +
+		                ", use " + ', '.join(normalization_keys))
+
+	# The models of a movie are fitted on their own pool, a movie task
+	# waiting for its fits must not hold up the pool they run on
+	model_executor = None
+	if len(models) > 1 or n_bootstrap > 0:
+		model_executor = Executors.newFixedThreadPool(Prefs.getThreads())
+
+	tasks = []
+	for name in sorted(os.listdir(folder)):
+		movie_path = os.path.join(folder, name)
+		if os.path.splitext(name)[1].lower() not in ['.tif', '.tiff']:
+			continue
+		roi_path = findRoiSet(movie_path)
+		if roi_path is None:
+			IJ.log('No ROI set for ' + name + ', skipped')
+			continue
+		tasks.append(FRAPTask(movie_path, roi_path, channel, max_frame,
+		                      autoFRAPflag, manual_FRAP_frame, default_interval,
+		                      models, criterion, model_executor, n_bootstrap,
+		                      normalization))
+
+	IJ.log('Analyzing %d FRAP movies in %s' % (len(tasks), folder))
+
+	executor = Executors.newFixedThreadPool(Prefs.getThreads())
+	futures = executor.invokeAll(tasks)
+	executor.shutdown()
+	if model_executor is not None:
+		model_executor.shutdown()
+
+	rt = ResultsTable()
+	results = []
+	for task, future in zip(tasks, futures):
+		try:
+			movie_results = future.get()
+		except (Exception, Throwable), e:
+			IJ.log('Analysis of ' + task.movie_path + ' failed: ' + str(e))
+			continue
+
+		for result in movie_results:
+			results.append(result)
+			rt.incrementCounter()
+			rt.addValue('Movie', result['title'])
+			rt.addValue('Spot', str(result['spot']))
+			rt.addValue('Frame.interval', result['frame_interval'])
+			rt.addValue('Time.unit', result['time_units'])
+			addFitValues(rt, result, n_bootstrap)
+	rt.disableRowLabels()
+
+	results_path = os.path.join(folder, 'FRAP_results.csv')
+	rt.save(results_path)
+	IJ.log('FRAP results saved to ' + results_path)
+
+	if not GraphicsEnvironment.isHeadless():
+		rt.show('FRAP batch results')
+
+	# Double normalized curves need the offset, as in fitFRAP
+	if global_model != '' and len(results) > 0:
+		globalFRAP(results, (global_model == 'exp_offset' or
+		                     normalization == 'double'),
+		           os.path.join(folder, 'FRAP_global_results.csv'))
+
+	return rt
+
+def globalFRAP(results, offsetFlag, results_path):
+	'''
+	Runs globalRecoveryFit on the curves of several FRAP analyses, and
+	saves one row per movie
+	arguments results: list of dicts as made by fitFRAP, with a 'title'
+	and a 'spot',
+	offsetFlag: boolean, results_path: string, path of the csv file
+	returns the ResultsTable, or None if no curve is long enough
+	'''
+	for result in results:
+		if len(result['xtofit']) < 2:
+			IJ.log('Spot ' + str(result['spot']) + ' of ' + result['title'] +
+			       ' has fewer than 2 post bleach points, left out of the'
+			       ' global fit')
+	results = [result for result in results if len(result['xtofit']) >= 2]
+	if len(results) == 0:
+		IJ.log('No curves to fit globally')
+		return None
+
+	fit = globalRecoveryFit([(result['xtofit'], result['ytofit'])
+	                         for result in results], offsetFlag)
+	IJ.log('Global fit of %d curves in %d iterations: T.half = %.3f, rate = %.4f +- %.4f'
+	       % (len(results), fit['iterations'], fit['thalf'], fit['rate'],
+	          fit['rate_se']))
+
+	rt = ResultsTable()
+	for i, result in enumerate(results):
+		rt.incrementCounter()
+		rt.addValue('Movie', result['title'])
+		rt.addValue('Spot', str(result['spot']))
+		rt.addValue('T.half', fit['thalf'])
+		rt.addValue('Rate', fit['rate'])
+		rt.addValue('Rate.SE', fit['rate_se'])
+		rt.addValue('Amplitude', fit['amplitudes'][i])
+		rt.addValue('Offset', fit['offsets'][i])
+		rt.addValue('Mobile.fraction', fit['mobile_fractions'][i])
+	rt.disableRowLabels()
+
+	rt.save(results_path)
+	IJ.log('Global FRAP results saved to ' + results_path)
+
+	if not GraphicsEnvironment.isHeadless():
+		rt.show('FRAP global fit')
+
+	return rt
+
+def batchOption(options, key, default):
+	'''
+	arguments options: macro options string or None, key: string,
+	default: value of the type to return
+	returns the value of key in options, or default if it is not given
+	'''
+	if options is None:
+		return default
+	return type(default)(Macro.getValue(options, key, str(default)))
+
+
+if __name__ in ['__main__', '__builtin__']:
+	options = Macro.getOptions()
+	batch_folder = batchOption(options, 'batch', '')
+
+	if batch_folder == '' and WindowManager.getCurrentImage() is None:
+		batch_folder = DirectoryChooser("Choose a folder of FRAP movies").getDirectory()
+		if batch_folder is None:
+			IJ.log("User canceled dialog!")
+			batch_folder = ''
 
+	if batch_folder != '':
+		bleach = batchOption(options, 'bleach', 0)
+		batchFRAP(batch_folder,
+		          channel=batchOption(options, 'channel', 1),
+		          max_frame=batchOption(options, 'frames', 105),
+		          autoFRAPflag=(bleach == 0),
+		          manual_FRAP_frame=bleach-1, #Sic 0-index!
+		          default_interval=batchOption(options, 'interval', 1.57),
+		          models=batchOption(options, 'models', 'exp').split(','),
+		          criterion=batchOption(options, 'criterion', 'AIC').upper(),
+		          n_bootstrap=batchOption(options, 'bootstrap', 0),
+		          normalization=batchOption(options, 'normalization',
+		                                    'bleach_depth'),
+		          global_model=batchOption(options, 'global', ''))
+	elif WindowManager.getCurrentImage() is not None:
+		interactiveFRAP()
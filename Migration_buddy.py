@@ -20,6 +20,12 @@ from ij.gui import PlotWindow as PlotWindow
 from ij.gui import GenericDialog
 import math
 from ij.measure import CurveFitter as CurveFitter
+from ij import Prefs
+from ij.process import ByteProcessor, ShortProcessor, FloatProcessor
+from java.util.concurrent import Callable, Executors
+from java.util.concurrent import ArrayBlockingQueue, TimeUnit
+from java.util.concurrent.atomic import AtomicReference
+from java.lang import Runnable, Thread, Throwable
 
 
 def setupDialog(imp):
@@ -38,8 +44,9 @@ def setupDialog(imp):
     channels = [str(ch) for ch in range(1, imp.getNChannels()+1)]  
     gd.addChoice("Channel to track:", channels, channels[1])
 
-    roichoises = ['Current active Roi','First Roi in RoiManager']    
-    gd.addChoice('Roi to use for tracking: (not implemented yet)', roichoises, roichoises[1])
+    roichoises = ['Current active Roi','First Roi in RoiManager','All Rois in RoiManager (one track per Roi)']    
+    gd.addChoice('Roi to use for tracking:', roichoises, roichoises[1])
+    gd.addChoice('Seed each frame from:', prediction_modes, prediction_modes[0])
     
     gd.addNumericField("Number of Roi centerings to perform per frame (3-6 is generally ok):", 6, 0)
     gd.addNumericField("Diameter of analysis Roi (in pixels):)",20,0)
@@ -52,6 +59,9 @@ def setupDialog(imp):
     gd.addCheckbox("Use scaled analysis ROI", True)
     gd.addCheckbox("Do colocalization analysis on Ch1 & Ch2", True)
     gd.addCheckbox("Plot Colocalization coefficients", False)
+    gd.addCheckbox("Draw tracking as overlay on the original (no copies)", False)
+    gd.addCheckbox("Flatten tracking overlay into a new RGB stack", False)
+    gd.addNumericField("Frames to prefetch in the background (0 = off):", 2, 0)
     
     gd.showDialog()  
 	  
@@ -77,6 +87,198 @@ def roiCenterer(ip, roi, cal):
     roi = OvalRoi(roi_x, roi_y, roi_w, roi_h)
     return roi
 
+def processorView(ip):
+    """Arguments: ip: 8-bit, 16-bit or 32-bit ImageProcessor
+    Returns a new ImageProcessor sharing the pixel array of ip, no pixels are copied.
+    Rois can be set on the view without disturbing other threads reading the same frame"""
+    w=ip.getWidth()
+    h=ip.getHeight()
+
+    if isinstance(ip, ByteProcessor):
+        return ByteProcessor(w, h, ip.getPixels(), None)
+    if isinstance(ip, ShortProcessor):
+        return ShortProcessor(w, h, ip.getPixels(), None)
+    return FloatProcessor(w, h, ip.getPixels(), None)
+
+def frameProcessors(stack, imp, channels, slice_no, frame):
+    """Arguments: stack: ImageStack of imp, imp: ImagePlus, channels: list of channel numbers,
+    slice_no: int, frame: int
+    Returns a dict mapping channel number to ImageProcessor, each channel is fetched only once"""
+    ips={}
+    for channel in channels:
+        if channel not in ips:
+            ips[channel]=stack.getProcessor(imp.getStackIndex(channel,slice_no,frame))
+    return ips
+
+class FramePrefetcher(Runnable):
+    """Arguments: stack: ImageStack of imp, imp: ImagePlus, channels: list of channel numbers,
+    slice_no: int, frames: list of frame numbers, depth: int
+    Iterating gives (frame, ips) pairs, ips as made by frameProcessors. With depth > 0 the next
+    depth frames are loaded on a background thread while the current one is analysed"""
+    def __init__(self, stack, imp, channels, slice_no, frames, depth=0):
+        self.stack=stack
+        self.imp=imp
+        self.channels=channels
+        self.slice_no=slice_no
+        self.frames=frames
+        self.thread=None
+        self.closed=False
+        self.error=AtomicReference()
+        if depth > 0:
+            self.queue=ArrayBlockingQueue(depth)
+            self.thread=Thread(self, "Frame prefetcher")
+            self.thread.setDaemon(True) #a reader blocked on a full queue must not keep Fiji alive
+            self.thread.start()
+
+    def run(self):
+        try:
+            for frame in self.frames:
+                self.queue.put((frame, frameProcessors(self.stack, self.imp, self.channels, self.slice_no, frame)))
+        except (Exception, Throwable), e:
+            if not self.closed:
+                self.error.set(e) #raised again in the analysis thread, the queue may be full
+
+    def __iter__(self):
+        for frame in self.frames:
+            if self.thread is None:
+                yield frame, frameProcessors(self.stack, self.imp, self.channels, self.slice_no, frame)
+                continue
+            loaded=None
+            while loaded is None:
+                loaded=self.queue.poll(100, TimeUnit.MILLISECONDS)
+                if loaded is None and self.error.get() is not None:
+                    raise self.error.get()
+                if loaded is None and not self.thread.isAlive():
+                    loaded=self.queue.poll()
+                    if loaded is None:
+                        raise Exception("Frame prefetcher stopped at frame %d" % frame)
+            yield loaded
+
+    def close(self):
+        """Stops the background thread, if it is still loading frames"""
+        self.closed=True
+        if self.thread is not None:
+            self.thread.interrupt()
+
+class CenteringTask(Callable):
+    """Runs roiCenterer no_of_centerings times on each roi in rois, through a private view of ip"""
+    def __init__(self, ip, rois, no_of_centerings, cal):
+        self.ip=ip
+        self.rois=rois
+        self.no_of_centerings=no_of_centerings
+        self.cal=cal
+
+    def call(self):
+        view=processorView(self.ip)
+        out=[]
+        for roi in self.rois:
+            for i in range(self.no_of_centerings):
+                roi=roiCenterer(view, roi, self.cal)
+            out.append(roi)
+        return out
+
+def centerRois(ip, rois, no_of_centerings, cal, executor=None):
+    """Arguments: ip:ImageProcessor, rois: list of rois, no_of_centerings: int, cal:calibration,
+    executor: ExecutorService or None
+    Returns a list of the rois centered with roiCenterer, in the same order as rois.
+    With an executor and more than one roi the rois are centered in parallel, one chunk per thread"""
+    if (executor is None) or (len(rois) < 2):
+        out=[]
+        for roi in rois:
+            for i in range(no_of_centerings):
+                roi=roiCenterer(ip, roi, cal)
+            out.append(roi)
+        return out
+
+    n_tasks=min(Prefs.getThreads(), len(rois))
+    edges=[len(rois)*t//n_tasks for t in range(n_tasks+1)]
+    tasks=[CenteringTask(ip, rois[edges[t]:edges[t+1]], no_of_centerings, cal) for t in range(n_tasks)]
+    out=[]
+    for future in executor.invokeAll(tasks):
+        out+=future.get()
+    return out
+
+# Ways to seed the Roi centering in a new frame, see TrackPredictor
+prediction_modes = ['Previous position', 'Constant velocity prediction', 'Kalman filter prediction']
+
+class TrackPredictor(object):
+    """Predicts the Roi position of a tracked object in the next frame: the previous position,
+    a constant velocity extrapolation, or a constant velocity Kalman filter on x and y separately.
+    Arguments: x, y: starting position, mode: index in prediction_modes,
+    process_noise: Kalman acceleration variance, measurement_noise: Kalman variance of a centered position"""
+    def __init__(self, x, y, mode=0, process_noise=1.0, measurement_noise=1.0):
+        self.mode=mode
+        self.q=process_noise
+        self.r=measurement_noise
+        self.pos=[x, y]
+        self.vel=[0.0, 0.0]
+        # Kalman covariance per axis, [p_pos_pos, p_pos_vel, p_vel_vel]
+        self.cov=[[measurement_noise, 0.0, 1e4], [measurement_noise, 0.0, 1e4]]
+        self.prediction=[x, y]
+        self.seeded=False
+
+    def predict(self):
+        """Returns the predicted x, y Roi position in the next frame"""
+        if self.mode == 0:
+            self.prediction=list(self.pos)
+        else:
+            if self.mode == 2:
+                q=self.q
+                for axis in range(2):
+                    ppp, ppv, pvv=self.cov[axis]
+                    # P = F P F' + Q, with F = [[1, 1], [0, 1]]
+                    self.cov[axis]=[ppp+2*ppv+pvv+q/4.0, ppv+pvv+q/2.0, pvv+q]
+            self.prediction=[p+v for p, v in zip(self.pos, self.vel)]
+        return self.prediction[0], self.prediction[1]
+
+    def update(self, x, y):
+        """Arguments: x, y: the centered Roi position in the current frame, call predict first
+        Returns the innovation, the distance in pixels between predicted and measured position"""
+        measured=[x, y]
+        innovation=math.hypot(x-self.prediction[0], y-self.prediction[1])
+        if not self.seeded: #the jump from the seed Roi to its first centered position is no motion
+            self.seeded=True
+            self.pos=measured
+            self.cov=[[self.r, 0.0, 1e4], [self.r, 0.0, 1e4]]
+        elif self.mode == 2:
+            for axis in range(2):
+                ppp, ppv, pvv=self.cov[axis]
+                residual=measured[axis]-self.prediction[axis]
+                s=ppp+self.r
+                k_pos=ppp/s
+                k_vel=ppv/s
+                self.pos[axis]=self.prediction[axis]+k_pos*residual
+                self.vel[axis]=self.vel[axis]+k_vel*residual
+                self.cov[axis]=[(1-k_pos)*ppp, (1-k_pos)*ppv, pvv-k_vel*ppv]
+        else:
+            self.vel=[m-p for m, p in zip(measured, self.pos)]
+            self.pos=measured
+        return innovation
+
+def positionedRoi(roi, color, imp, channel, slice_no, frame):
+    """Arguments: roi:Region of intrest, color: java.awt.Color, imp: ImagePlus the Overlay is attached to,
+    channel, slice_no, frame: position where the roi is shown
+    Returns a colored copy of roi for the tracking Overlay, only shown at the given position"""
+    roi=roi.clone()
+    roi.setStrokeColor(color)
+    if imp.isHyperStack():
+        roi.setPosition(channel, slice_no, frame)
+    else:
+        roi.setPosition(imp.getStackIndex(channel, slice_no, frame))
+    return roi
+
+def flattenFrame(ip, rois):
+    """Arguments: ip:ImageProcessor, rois: list of rois as made by positionedRoi
+    Returns a ColorProcessor, an RGB copy of ip with the rois burnt in"""
+    overlay=Overlay()
+    for roi in rois:
+        roi=roi.clone()
+        roi.setPosition(0)
+        overlay.add(roi)
+    frame_imp=ImagePlus("", ip)
+    frame_imp.setOverlay(overlay)
+    return frame_imp.flatten().getProcessor()
+
 def roiScaler(roi, new_diameter):
     """Agruments: roi: Region of intrest, new_diameter: returned roi diameter
     Returns a new OvalRoi centered on the input roi diameter""" 
@@ -261,7 +463,8 @@ gd=setupDialog(imp)
 frame_interval = gd.getNextNumber()
 time_unit = gd.getNextString()
 channel_to_track = int(gd.getNextChoice())
-roi_to_use = gd.getNextChoice()  
+roi_to_use = gd.getNextChoiceIndex() #0 for current, 1 for first, 2 for all
+prediction_mode = gd.getNextChoiceIndex() #index in prediction_modes
 no_of_centerings = int(gd.getNextNumber())
 analsis_roi_diameter = int(gd.getNextNumber())
 start_frame = int(gd.getNextNumber())
@@ -281,6 +484,13 @@ showCropFlag=gd.getNextBoolean()
 analysisRoiFlag=gd.getNextBoolean()
 colocalizationFlag=gd.getNextBoolean()
 showColPlotFlag=gd.getNextBoolean()
+overlayFlag=gd.getNextBoolean()
+flattenFlag=gd.getNextBoolean()
+prefetch_depth = max(0, int(gd.getNextNumber()))
+
+# The overlay replaces the pixel copies of the tracked channel
+if overlayFlag:
+    showTrackFlag = False
     
 #Set the frame interval in calibration
     
@@ -292,6 +502,13 @@ imp.setCalibration(cal)
 stack = imp.getImageStack()
 stack_track = imp.createEmptyStack()
 
+# Tracking overlay, added to any overlay the image already has
+if overlayFlag:
+    overlay = imp.getOverlay()
+    if overlay is None:
+        overlay = Overlay()
+    stack_flat = ImageStack(imp.getWidth(), imp.getHeight())
+
 title = imp.getTitle()
 n_channels = imp.getNChannels()
 stack_to_track=1
@@ -299,16 +516,32 @@ stack_to_track=1
 
 
 # Get the ROIs
-roi_manager = RoiManager.getInstance()
-roi_list    = roi_manager.getRoisAsArray()
+multiObjectFlag = (roi_to_use == 2)
+
+if (roi_to_use == 0) and (imp.getRoi() is not None):
+    seed_rois = [imp.getRoi()]
+else:
+    roi_manager = RoiManager.getInstance()
+    roi_list    = roi_manager.getRoisAsArray()
+    if multiObjectFlag:
+        seed_rois = list(roi_list)
+    else:
+        seed_rois = [roi_list[0]]
+
+# One track per ROI, [x, y, w, h]
+tracks = [[roi.getXBase(), roi.getYBase(), roi.getFloatWidth(), roi.getFloatHeight()] for roi in seed_rois]
+
+roi_w=tracks[0][2]
+roi_h=tracks[0][3]
 
-# We will use the first ROI in the Roi manager for now.
-roi_1 = roi_list[0];
+# Seeds the centering of each object in the next frame
+predictors = [TrackPredictor(x, y, prediction_mode) for x, y, w, h in tracks]
 
-roi_x=roi_1.getXBase()
-roi_y=roi_1.getYBase()
-roi_w=roi_1.getFloatWidth()
-roi_h=roi_1.getFloatHeight()
+# Crops and plots are only made for single object tracking
+if multiObjectFlag:
+    showCropFlag = False
+    showPlotFlag = False
+    showColPlotFlag = False
 
 if analysisRoiFlag:
     stack_crop = ImageStack(int(analsis_roi_diameter), int(analsis_roi_diameter))
@@ -319,6 +552,13 @@ else:
 #Create a dictionary to keep track of results
 result_dict={}
 result_keys=['means_ch1','means_ch2','ch1x','ch1y','ch2x','ch2y']
+
+# Long format, one row per object and frame
+if multiObjectFlag:
+    result_keys = ['object', 'frame'] + result_keys
+
+if prediction_mode > 0:
+    result_keys.append('innovation')
     
 if colocalizationFlag:
     extra_keys=['M1', 'M2', 'Pearson', 'overlap_coefficient']
@@ -328,59 +568,101 @@ if colocalizationFlag:
 for key in result_keys:
     result_dict[key]=[]
   
+# Worker threads for centering many objects
+if multiObjectFlag:
+    executor = Executors.newFixedThreadPool(Prefs.getThreads())
+else:
+    executor = None
 
-#loop through the frames that you want to track
-for frame in range(start_frame, stop_frame+1):
-    # Get the imageProcessor of the channel to track at the current frame
-    track_ip = stack.getProcessor(imp.getStackIndex(channel_to_track,stack_to_track,frame))
-    track_roi = OvalRoi(roi_x, roi_y, roi_w, roi_h)
-    
-    #Do the Roi centering the desired number of times
-    for i in range (no_of_centerings):
-        track_roi=roiCenterer(track_ip, track_roi, cal)
-    
-    roi_x=track_roi.getXBase()
-    roi_y=track_roi.getYBase()
-    track_ip.setRoi(track_roi)
-
-    if analysisRoiFlag:
-        analysis_roi=roiScaler(track_roi, analsis_roi_diameter)
-    else:
-        analysis_roi=track_roi.clone()
-    
-    #Get Channel 1&2 IPs and apply the centered roi with the desired diameter
-    
-    ip1 = stack.getProcessor(imp.getStackIndex(1,stack_to_track,frame))
-    ip1_crop=channelStats(ip1, 1, analysis_roi, result_dict, cal)
-    
-    ip2 = stack.getProcessor(imp.getStackIndex(2,stack_to_track,frame))
-    ip2_crop=channelStats(ip2, 2, analysis_roi, result_dict, cal)
-
-    if colocalizationFlag:
-        colocRecorder(ip1_crop, ip2_crop, result_dict)
-
-    if showTrackFlag:
-        ip_track=track_ip.duplicate()
-        ip_track.setColor(track_ip.maxValue())
-        ip_track.draw(track_roi)
-        
-        if analysisRoiFlag:
-            ip_track.setColor(track_ip.maxValue()/2)
-            ip_track.draw(analysis_roi)
-        stack_track.addSlice(ip_track)
-
-    if showCropFlag:       
-        #ip_crop.setColor(ip.maxValue())
-        #ip_crop.draw(analysis_roi)
-        stack_crop.addSlice(ip1_crop)
-        stack_crop.addSlice(ip2_crop)
+# Loads the imageProcessors of the coming frames while one is analysed, each channel only once
+prefetcher = FramePrefetcher(stack, imp, [channel_to_track, 1, 2], stack_to_track,
+                             range(start_frame, stop_frame+1), prefetch_depth)
 
+#loop through the frames that you want to track
+try:
+    for frame, ips in prefetcher:
+        track_ip = ips[channel_to_track]
+        track_rois = []
+        for predictor, track in zip(predictors, tracks):
+            seed_x, seed_y = predictor.predict()
+            track_rois.append(OvalRoi(seed_x, seed_y, track[2], track[3]))
+
+        #Do the Roi centering the desired number of times, for all objects
+        track_rois = centerRois(track_ip, track_rois, no_of_centerings, cal, executor)
+
+        if showTrackFlag:
+            ip_track=track_ip.duplicate()
+
+        frame_rois = []
+
+        for obj, track_roi in enumerate(track_rois):
+            tracks[obj][0]=track_roi.getXBase()
+            tracks[obj][1]=track_roi.getYBase()
+
+            if analysisRoiFlag:
+                analysis_roi=roiScaler(track_roi, analsis_roi_diameter)
+            else:
+                analysis_roi=track_roi.clone()
+
+            if multiObjectFlag:
+                result_dict['object'].append(obj+1)
+                result_dict['frame'].append(frame)
+
+            innovation = predictors[obj].update(tracks[obj][0], tracks[obj][1])
+            if prediction_mode > 0:
+                result_dict['innovation'].append(innovation)
+
+            #Apply the centered roi with the desired diameter to Channel 1&2 IPs
+            ip1_crop=channelStats(ips[1], 1, analysis_roi, result_dict, cal)
+            ip2_crop=channelStats(ips[2], 2, analysis_roi, result_dict, cal)
+
+            if colocalizationFlag:
+                colocRecorder(ip1_crop, ip2_crop, result_dict)
+
+            if showTrackFlag:
+                ip_track.setColor(track_ip.maxValue())
+                ip_track.draw(track_roi)
+
+                if analysisRoiFlag:
+                    ip_track.setColor(track_ip.maxValue()/2)
+                    ip_track.draw(analysis_roi)
+
+            if overlayFlag:
+                frame_rois.append(positionedRoi(track_roi, Color.YELLOW, imp, channel_to_track, stack_to_track, frame))
+                if analysisRoiFlag:
+                    frame_rois.append(positionedRoi(analysis_roi, Color.CYAN, imp, channel_to_track, stack_to_track, frame))
+
+            if showCropFlag:       
+                #ip_crop.setColor(ip.maxValue())
+                #ip_crop.draw(analysis_roi)
+                stack_crop.addSlice(ip1_crop)
+                stack_crop.addSlice(ip2_crop)
+
+        if showTrackFlag:
+            stack_track.addSlice(ip_track)
+
+        if overlayFlag:
+            for roi in frame_rois:
+                overlay.add(roi)
+            if flattenFlag:
+                stack_flat.addSlice(flattenFrame(track_ip, frame_rois))
+finally:
+    prefetcher.close()
+    if executor is not None:
+        executor.shutdown()
 
 if showTrackFlag:    
     imp_track = ImagePlus(title+'_Processed', stack_track)
     imp_track.setCalibration(cal)
     imp_track.show()
 
+if overlayFlag:
+    imp.setOverlay(overlay)
+    if flattenFlag:
+        imp_flat = ImagePlus(title+'_Tracking', stack_flat)
+        imp_flat.setCalibration(cal)
+        imp_flat.show()
+
 if showCropFlag:
     imp_crop = IJ.createHyperStack(title+"_analysis_crop", int(roi_w), int(roi_h), n_channels, 1, no_frames_tracked, imp.getBitDepth())
     imp_crop.setStack(stack_crop)
@@ -390,7 +672,7 @@ if showCropFlag:
 if showResultsFlag:
     IJ.run("Clear Results")
     rt=ResultsTable()
-    for index in range(no_frames_tracked):
+    for index in range(len(result_dict['means_ch1'])):
         rt.incrementCounter()
         for key in result_keys:
             rt.addValue(str(key),result_dict[key][index])
@@ -31,6 +31,7 @@ from ij import WindowManager as WindowManager
 from ij.plugin.frame import RoiManager as RoiManager
 from ij import IJ, ImagePlus, ImageStack
 import ij.process.ImageStatistics as ImageStatistics
+from ij.process import ByteProcessor, ShortProcessor, FloatProcessor
 from ij.measure import Measurements as Measurements
 from ij import IJ as IJ
 import java.awt.Color as Color
@@ -38,6 +39,18 @@ from ij.gui import Plot as Plot
 from ij.gui import PlotWindow as PlotWindow
 from ij.gui import GenericDialog
 import math
+import random
+from itertools import izip
+from ij import Prefs
+from java.util.concurrent import Callable, Executors
+from java.util.concurrent import ArrayBlockingQueue, TimeUnit
+from java.util.concurrent.atomic import AtomicReference
+from java.lang import Runnable, Thread, Throwable
+from java.io import FileOutputStream, RandomAccessFile
+from java.nio import ByteBuffer
+from java.lang import String
+from ij.io import SaveDialog
+from ij.plugin import FileInfoVirtualStack
 from ij.measure import CurveFitter as CurveFitter
 
 
@@ -78,8 +91,11 @@ def setupDialog(imp):
     
     gd.addChoice("Channel to track:", channels, channels[imp.getChannel()-1]) 
 
-    roichoises = ['Currently active Roi','First Roi in RoiManager']    
+    roichoises = ['Currently active Roi','First Roi in RoiManager',
+                  'All Rois in RoiManager (one track per Roi)']    
     gd.addChoice('Roi to use for tracking:', roichoises, roichoises[0])
+    gd.addChoice('Seed each frame from:', prediction_modes,
+                 prediction_modes[0])
     
     gd.addNumericField("Nr. of Roi centerings to do per frame:", 6, 0)
     gd.addNumericField("Diameter of analysis Roi (in pixels):)",20,0)
@@ -95,6 +111,18 @@ def setupDialog(imp):
     gd.addCheckbox("Use scaled analysis ROI", False)
     gd.addCheckbox("Do colocalization analysis on Ch1 & Ch2", True)
     gd.addCheckbox("Plot Colocalization coefficients", False)
+    gd.addCheckbox("Use Costes automatic threshold for M1, M2 & Pearson", False)
+    gd.addCheckbox("Costes randomization P-value for Pearson", False)
+    gd.addNumericField("Nr. of Costes randomizations per frame:", 200, 0)
+    gd.addNumericField("Costes randomization block size (in pixels):", 3, 0)
+    gd.addCheckbox("Stop centering once the Roi has converged", False)
+    gd.addNumericField("Convergence tolerance (in pixels):", 0.05, 2)
+    gd.addCheckbox("Draw tracking as overlay on the original (no copies)",
+                   False)
+    gd.addCheckbox("Flatten tracking overlay into a new RGB stack", False)
+    gd.addCheckbox("Stream cropped region to disk (virtual stack)", False)
+    gd.addNumericField("Frames to prefetch in the background (0 = off):",
+                       2, 0)
     
     gd.showDialog()  
       
@@ -134,6 +162,594 @@ def roiCenterer(ip, roi, cal):
     
     return out_roi
 
+def processorView(ip):
+    """
+    Wraps the pixel array of ip in a new ImageProcessor, without copying
+    any pixels. Rois can be set on the view from one thread without
+    disturbing other threads reading the same frame.
+
+    Args:
+        ip: ImageProcessor, 8-bit, 16-bit or 32-bit
+
+    Returns:
+        ImageProcessor sharing its pixels with ip
+    """
+    w = ip.getWidth()
+    h = ip.getHeight()
+
+    if isinstance(ip, ByteProcessor):
+        return ByteProcessor(w, h, ip.getPixels(), None)
+
+    if isinstance(ip, ShortProcessor):
+        return ShortProcessor(w, h, ip.getPixels(), None)
+
+    return FloatProcessor(w, h, ip.getPixels(), None)
+
+def frameProcessors(stack, imp, channels, slice_no, frame):
+    """
+    Fetches the ImageProcessors of one frame, each channel only once
+
+    Args:
+        stack: ImageStack of imp
+        imp: ImagePlus, used for the stack index arithmetic
+        channels: list of channel numbers, may contain duplicates
+        slice_no: int, Z-slice
+        frame: int, frame number
+
+    Returns:
+        dict mapping channel number to ImageProcessor
+    """
+    ips = {}
+
+    for channel in channels:
+        if channel not in ips:
+            ips[channel] = stack.getProcessor(imp.getStackIndex(channel,
+                                              slice_no, frame))
+
+    return ips
+
+class FramePrefetcher(Runnable):
+    """
+    Iterates over the frames of a stack, yielding (frame, ips) pairs where
+    ips is the dict made by frameProcessors. With a depth above 0 the
+    processors of the next depth frames are loaded on a background
+    thread while the current frame is analysed, so that reading a
+    virtual stack from a slow disk overlaps with the tracking.
+    
+    Args:
+        stack: ImageStack of imp
+        imp: ImagePlus, used for the stack index arithmetic
+        channels: list of channel numbers, may contain duplicates
+        slice_no: int, Z-slice
+        frames: list of frame numbers, in the order they are analysed
+        depth: int, maximum number of frames loaded ahead, 0 loads each
+            frame when it is asked for
+    """
+    def __init__(self, stack, imp, channels, slice_no, frames, depth=0):
+        self.stack = stack
+        self.imp = imp
+        self.channels = channels
+        self.slice_no = slice_no
+        self.frames = frames
+        self.depth = depth
+        self.thread = None
+        self.closed = False
+        self.error = AtomicReference()
+
+        if depth > 0:
+            self.queue = ArrayBlockingQueue(depth)
+            self.thread = Thread(self, "Frame prefetcher")
+            # A reader blocked on a full queue must not keep Fiji alive
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def run(self):
+        try:
+            for frame in self.frames:
+                self.queue.put((frame, frameProcessors(self.stack,
+                                self.imp, self.channels, self.slice_no,
+                                frame)))
+        except (Exception, Throwable), e:
+            # Handed to the analysis thread, unless close() stopped us.
+            # The queue may be full, so it goes through its own field
+            if not self.closed:
+                self.error.set(e)
+
+    def __iter__(self):
+        for frame in self.frames:
+            if self.thread is None:
+                yield frame, frameProcessors(self.stack, self.imp,
+                                             self.channels, self.slice_no,
+                                             frame)
+                continue
+
+            loaded = None
+            while loaded is None:
+                loaded = self.queue.poll(100, TimeUnit.MILLISECONDS)
+                if loaded is None and self.error.get() is not None:
+                    raise self.error.get()
+                if loaded is None and not self.thread.isAlive():
+                    loaded = self.queue.poll()
+                    if loaded is None:
+                        raise Exception("Frame prefetcher stopped at "
+                                        "frame %d" % frame)
+            yield loaded
+
+    def close(self):
+        """
+        Stops the background thread, if it is still loading frames
+        """
+        self.closed = True
+        if self.thread is not None:
+            self.thread.interrupt()
+
+def centerRoi(ip, roi, no_of_centerings, cal, tolerance=0):
+    """
+    Centers roi on the center of mass in ip, either a fixed number of
+    times with roiCenterer, or with roiCentererConverging if a tolerance
+    is given, in which case no_of_centerings is the iteration cap.
+
+    Returns:
+        the centered OvalRoi and the number of centerings done
+    """
+    if tolerance > 0:
+        return roiCentererConverging(ip, roi, tolerance, no_of_centerings)
+
+    for i in range(no_of_centerings):
+        roi = roiCenterer(ip, roi, cal)
+
+    return roi, no_of_centerings
+
+class CenteringTask(Callable):
+    """
+    Runs centerRoi on each roi in a list, through a private view of the
+    frame
+    """
+    def __init__(self, ip, rois, no_of_centerings, cal, tolerance):
+        self.ip = ip
+        self.rois = rois
+        self.no_of_centerings = no_of_centerings
+        self.cal = cal
+        self.tolerance = tolerance
+
+    def call(self):
+        view = processorView(self.ip)
+
+        return [centerRoi(view, roi, self.no_of_centerings, self.cal,
+                          self.tolerance) for roi in self.rois]
+
+def centerRois(ip, rois, no_of_centerings, cal, executor=None, tolerance=0):
+    """
+    Centers every roi in rois on its center of mass in ip, see centerRoi.
+    With an executor and more than one roi the objects are split in one
+    chunk per thread and centered in parallel.
+
+    Args:
+        ip: ImageProcessor
+        rois: list of rois, one per tracked object
+        no_of_centerings: int, number of centerings per roi, or the
+          maximum number if a tolerance is given
+        cal: Calibration of the ip
+        executor: ExecutorService, defaults to None
+        tolerance: float, stop centering once the roi moves less than
+          this many pixels, defaults to 0 (always do no_of_centerings)
+
+    Returns:
+        list of centered OvalRois, in the same order as rois, and a list
+        with the number of centerings done for each roi
+    """
+    if (executor is None) or (len(rois) < 2):
+        out = [centerRoi(ip, roi, no_of_centerings, cal, tolerance)
+               for roi in rois]
+
+    else:
+        n_tasks = min(Prefs.getThreads(), len(rois))
+        edges = [len(rois)*t//n_tasks for t in range(n_tasks+1)]
+        tasks = [CenteringTask(ip, rois[edges[t]:edges[t+1]],
+                               no_of_centerings, cal, tolerance)
+                 for t in range(n_tasks)]
+        out = []
+
+        for future in executor.invokeAll(tasks):
+            out += future.get()
+
+    return [roi for roi, n in out], [n for roi, n in out]
+
+def maskCentroid(ip, roi):
+    """
+    Calculates the center of mass inside roi straight from the pixel array,
+    reading only the pixels of the roi bounding box. Gives the same raw
+    position as ImageStatistics.CENTER_OF_MASS, but does not set the roi
+    on ip and does no other statistics.
+    
+    Args:
+        ip: ImageProcessor
+        roi: Region of intrest
+    
+    Returns:
+        floats x, y, the raw center of mass
+    """
+    pixels = ip.getPixels()
+    width = ip.getWidth()
+    bit_depth = ip.getBitDepth()
+    bounds = roi.getBounds()
+    mask = roi.getMask()
+
+    if mask is not None:
+        mask = mask.getPixels()
+
+    x0 = max(bounds.x, 0)
+    y0 = max(bounds.y, 0)
+    x1 = min(bounds.x + bounds.width, width)
+    y1 = min(bounds.y + bounds.height, ip.getHeight())
+
+    total = xsum = ysum = 0
+    count = xcount = ycount = 0
+
+    for y in range(y0, y1):
+        offset = y*width
+        mask_offset = (y-bounds.y)*bounds.width - bounds.x
+        for x in range(x0, x1):
+            if (mask is not None) and (mask[mask_offset + x] == 0):
+                continue
+            v = pixels[offset + x]
+            if bit_depth == 8:
+                v &= 0xff
+            elif bit_depth == 16:
+                v &= 0xffff
+            total += v
+            xsum += x*v
+            ysum += y*v
+            count += 1
+            xcount += x
+            ycount += y
+
+    if total == 0: # Geometric center, as ImageStatistics does
+        if count == 0:
+            return (x0+x1)*0.5, (y0+y1)*0.5
+        return xcount/float(count) + 0.5, ycount/float(count) + 0.5
+
+    return xsum/float(total) + 0.5, ysum/float(total) + 0.5
+
+def roiCentererConverging(ip, roi, tolerance, max_centerings):
+    """
+    Centers the given roi on the center of mass inside the roi, repeating
+    until the roi moves less than tolerance pixels or max_centerings
+    centerings have been done. Uses maskCentroid, so it is safe to call
+    from several threads on the same ip.
+    
+    Args:
+        ip: ImageProcessor
+        roi: Region of intrest
+        tolerance: float, sub-pixel shift that counts as converged
+        max_centerings: int, hard cap on the number of centerings
+    
+    Returns:
+        the centered OvalRoi and the number of centerings done
+    """
+    roi_x = roi.getXBase()
+    roi_y = roi.getYBase()
+    roi_w = roi.getFloatWidth()
+    roi_h = roi.getFloatHeight()
+    n = 0
+
+    while n < max_centerings:
+        x, y = maskCentroid(ip, roi)
+        shift = math.hypot(x-roi_w/2 - roi_x, y-roi_h/2 - roi_y)
+        roi_x = x-roi_w/2
+        roi_y = y-roi_h/2
+        roi = OvalRoi(roi_x, roi_y, roi_w, roi_h)
+        n += 1
+
+        if shift < tolerance:
+            break
+
+    return roi, n
+
+# Ways to seed the Roi centering in a new frame, see TrackPredictor
+prediction_modes = ['Previous position', 'Constant velocity prediction',
+                    'Kalman filter prediction']
+
+class TrackPredictor(object):
+    """
+    Predicts the Roi position of a tracked object in the next frame, so
+    that the centering starts close to where the object went. Either the
+    previous position (no prediction), a constant velocity extrapolation
+    of the last two positions, or a constant velocity Kalman filter with
+    independent x and y axes.
+    """
+    def __init__(self, x, y, mode=0, process_noise=1.0,
+                 measurement_noise=1.0):
+        """
+        Args:
+            x, y: starting Roi position
+            mode: int, index in prediction_modes
+            process_noise: Kalman acceleration variance, in pixels^2/frame^4
+            measurement_noise: Kalman variance of a centered position, in
+              pixels^2
+        """
+        self.mode = mode
+        self.q = process_noise
+        self.r = measurement_noise
+        self.pos = [x, y]
+        self.vel = [0.0, 0.0]
+        # Kalman covariance per axis, [p_pos_pos, p_pos_vel, p_vel_vel]
+        self.cov = [[measurement_noise, 0.0, 1e4], [measurement_noise, 0.0, 1e4]]
+        self.prediction = [x, y]
+        self.seeded = False
+
+    def predict(self):
+        """
+        Returns:
+            floats x, y, the predicted Roi position in the next frame
+        """
+        if self.mode == 0:
+            self.prediction = list(self.pos)
+
+        elif self.mode == 1:
+            self.prediction = [p+v for p, v in zip(self.pos, self.vel)]
+
+        else:
+            q = self.q
+            for axis in range(2):
+                ppp, ppv, pvv = self.cov[axis]
+                # P = F P F' + Q, with F = [[1, 1], [0, 1]]
+                self.cov[axis] = [ppp + 2*ppv + pvv + q/4.0,
+                                  ppv + pvv + q/2.0,
+                                  pvv + q]
+            self.prediction = [p+v for p, v in zip(self.pos, self.vel)]
+
+        return self.prediction[0], self.prediction[1]
+
+    def update(self, x, y):
+        """
+        Feeds the centered Roi position of the current frame to the
+        predictor. Call predict first.
+
+        Args:
+            x, y: measured Roi position
+
+        Returns:
+            float, the innovation, i.e. the distance in pixels between the
+            predicted and the measured position
+        """
+        measured = [x, y]
+        innovation = math.hypot(x-self.prediction[0], y-self.prediction[1])
+
+        # The jump from the seed Roi to its first centered position is no
+        # motion, so the first measurement only sets the position
+        if not self.seeded:
+            self.seeded = True
+            self.pos = measured
+            self.cov = [[self.r, 0.0, 1e4], [self.r, 0.0, 1e4]]
+
+        elif self.mode == 2:
+            for axis in range(2):
+                ppp, ppv, pvv = self.cov[axis]
+                residual = measured[axis] - self.prediction[axis]
+                s = ppp + self.r
+                k_pos = ppp/s
+                k_vel = ppv/s
+                self.pos[axis] = self.prediction[axis] + k_pos*residual
+                self.vel[axis] = self.vel[axis] + k_vel*residual
+                self.cov[axis] = [(1-k_pos)*ppp, (1-k_pos)*ppv,
+                                  pvv - k_vel*ppv]
+        else:
+            self.vel = [m-p for m, p in zip(measured, self.pos)]
+            self.pos = measured
+
+        return innovation
+
+def positionedRoi(roi, color, imp, channel, slice_no, frame):
+    """
+    Prepares a roi for the tracking Overlay of imp
+    
+    Args:
+        roi: Region of intrest
+        color: java.awt.Color to draw the roi in
+        imp: ImagePlus that the Overlay is attached to
+        channel, slice_no, frame: position where the roi is shown
+    
+    Returns:
+        a colored copy of roi, only shown at the given position
+    """
+    roi = roi.clone()
+    roi.setStrokeColor(color)
+
+    if imp.isHyperStack():
+        roi.setPosition(channel, slice_no, frame)
+    else:
+        roi.setPosition(imp.getStackIndex(channel, slice_no, frame))
+
+    return roi
+
+def flattenFrame(ip, rois):
+    """
+    Burns rois into an RGB copy of ip, for when the tracking overlay has
+    to become pixels
+    
+    Args:
+        ip: ImageProcessor
+        rois: list of rois, as made by positionedRoi
+    
+    Returns:
+        ColorProcessor with the rois drawn on ip
+    """
+    overlay = Overlay()
+
+    for roi in rois:
+        roi = roi.clone()
+        roi.setPosition(0)
+        overlay.add(roi)
+
+    frame_imp = ImagePlus("", ip)
+    frame_imp.setOverlay(overlay)
+
+    return frame_imp.flatten().getProcessor()
+
+class TiffStreamWriter(object):
+    """
+    Appends ImageProcessors to an uncompressed TIFF file on disk, so that
+    long tracks do not have to be held in memory. Pixels are written in
+    batches of batch_size images, the image directories go to the end of
+    the file when it is closed. All offsets are 32 bit, so the file can
+    not grow beyond 4 GB.
+    
+    Args:
+        path: file to write to, it is overwritten
+        n_channels: channels per frame, for the ImageJ hyperstack header
+        batch_size: number of images kept in memory between two writes
+    """
+    def __init__(self, path, n_channels=1, batch_size=16):
+        self.path = path
+        self.n_channels = n_channels
+        self.batch_size = max(1, batch_size)
+        self.width = self.height = self.bit_depth = None
+        self.n_images = 0
+        self.pending = []
+        self.offset = 8
+        self.out = FileOutputStream(path)
+
+        # Big endian header, the offset of the first directory is patched
+        # in by close()
+        header = ByteBuffer.allocate(8)
+        header.putShort(0x4d4d).putShort(42).putInt(0)
+        self.out.write(header.array())
+
+    def append(self, ip):
+        """
+        Queues ip for writing, flushes the queue every batch_size images
+        
+        Args:
+            ip: ImageProcessor of the same size and type as the first one
+        """
+        if self.bit_depth is None:
+            if ip.getBitDepth() not in (8, 16, 32):
+                raise Exception("Only 8, 16 and 32 bit images can be "
+                                "streamed to disk")
+            self.width = ip.getWidth()
+            self.height = ip.getHeight()
+            self.bit_depth = ip.getBitDepth()
+
+        elif (ip.getWidth() != self.width or ip.getHeight() != self.height
+              or ip.getBitDepth() != self.bit_depth):
+            raise Exception("Image dimensions or type do not match")
+
+        pixels = ip.getPixels()
+
+        if self.bit_depth == 8:
+            data = pixels
+        else:
+            data = ByteBuffer.allocate(len(pixels)*self.bit_depth/8)
+            if self.bit_depth == 16:
+                data.asShortBuffer().put(pixels)
+            else:
+                data.asFloatBuffer().put(pixels)
+            data = data.array()
+
+        if self.offset + len(data) > 0xffffffff:
+            raise Exception("Streamed TIFF files are limited to 4 GB")
+
+        self.pending.append(data)
+        self.offset += len(data)
+        self.n_images += 1
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all queued images to disk
+        """
+        for data in self.pending:
+            self.out.write(data)
+        self.out.flush()
+        self.pending = []
+
+    def close(self):
+        """
+        Writes the remaining images and the image directories, and closes
+        the file
+
+        Returns:
+            the path of the file, or None if no image was appended
+        """
+        self.flush()
+
+        if self.n_images == 0:
+            self.out.close()
+            return None
+
+        description = ("ImageJ=%s\nimages=%d\nchannels=%d\nframes=%d\n"
+                       "hyperstack=true\n\0"
+                       % (IJ.getVersion(), self.n_images, self.n_channels,
+                          self.n_images/self.n_channels))
+        description = String(description).getBytes("US-ASCII")
+        self.out.write(description)
+
+        description_offset = self.offset
+        ifd_offset = self.offset + len(description)
+        padding = ifd_offset % 2
+        ifd_offset += padding
+
+        image_bytes = self.width*self.height*self.bit_depth/8
+        n_tags = 10
+        if self.bit_depth == 32:
+            n_tags += 1
+        ifd_size = 2 + 12*n_tags + 4
+
+        def signed(value):
+            # ByteBuffer.putInt only takes signed 32 bit values
+            if value > 0x7fffffff:
+                return value - 0x100000000
+            return value
+
+        def tag(ifd, code, field_type, count, value):
+            ifd.putShort(code).putShort(field_type).putInt(count)
+            if field_type == 3:
+                ifd.putShort(value).putShort(0)
+            else:
+                ifd.putInt(signed(value))
+
+        ifds = ByteBuffer.allocate(padding + ifd_size*self.n_images)
+        ifds.position(padding)
+
+        for i in range(self.n_images):
+            first = (i == 0)
+            next_ifd = 0
+            if i < self.n_images - 1:
+                next_ifd = ifd_offset + (i + 1)*ifd_size
+
+            ifds.putShort(n_tags - (not first))
+            tag(ifds, 254, 4, 1, 0)
+            tag(ifds, 256, 4, 1, self.width)
+            tag(ifds, 257, 4, 1, self.height)
+            tag(ifds, 258, 3, 1, self.bit_depth)
+            tag(ifds, 262, 3, 1, 1)
+            if first:
+                tag(ifds, 270, 2, len(description), description_offset)
+            tag(ifds, 273, 4, 1, 8 + i*image_bytes)
+            tag(ifds, 277, 3, 1, 1)
+            tag(ifds, 278, 4, 1, self.height)
+            tag(ifds, 279, 4, 1, image_bytes)
+            if self.bit_depth == 32:
+                tag(ifds, 339, 3, 1, 3)
+            ifds.putInt(signed(next_ifd))
+
+            # Only the first directory carries the description
+            if not first:
+                ifds.put(ByteBuffer.allocate(12).array())
+
+        self.out.write(ifds.array())
+        self.out.close()
+
+        header = RandomAccessFile(self.path, "rw")
+        header.seek(4)
+        header.writeInt(signed(ifd_offset))
+        header.close()
+
+        return self.path
+
 def roiScaler(roi, new_diameter):
     """
     Used if the tracking ROI has a hard time locking on to the object and
@@ -187,23 +803,176 @@ def channelStats(ip, channel, roi, resultdict, cal):
 
     return ip.crop()
 
-def colocRecorder(ip1, ip2, resultdict):
+def colocRecorder(ip1, ip2, resultdict, costesFlag=False,
+                  n_randomizations=0, block_size=3, executor=None):
     """
     Args:
         ip1: ImageProcessor
         ip2: ImageProcessor
         resultdict: dict that stores the results
+        costesFlag: also record the Costes thresholds and the thresholded
+          coefficients, defaults to False
+        n_randomizations: int, records the Costes randomization P-value
+          if > 0, defaults to 0
+        block_size: side of the scrambled blocks in pixels, defaults to 3
+        executor: ExecutorService running the randomizations
     
     Returns:
         nothing, updates resultdict
     """
-    m = calcMandersCoefficients(ip1, ip2)
-    resultdict['M1'].append(m[0])
-    resultdict['M2'].append(m[1])
-    resultdict['Pearson'].append(calcPearsonsCoefficient(ip1, ip2))
-    resultdict['overlap_coefficient'].append(calcOverlapCoefficient(ip1, ip2))
+    m1, m2, pearson, overlap = calcColocalizationCoefficients(ip1, ip2)
+    resultdict['M1'].append(m1)
+    resultdict['M2'].append(m2)
+    resultdict['Pearson'].append(pearson)
+    resultdict['overlap_coefficient'].append(overlap)
+
+    if costesFlag:
+        th_G, th_R = costesThreshold(ip1, ip2)
+        tm1, tm2, tpearson = calcColocalizationCoefficients(ip1, ip2,
+                                                            th_G, th_R)[:3]
+        resultdict['Costes_th_ch1'].append(th_G)
+        resultdict['Costes_th_ch2'].append(th_R)
+        resultdict['tM1'].append(tm1)
+        resultdict['tM2'].append(tm2)
+        resultdict['tPearson'].append(tpearson)
+
+    if n_randomizations > 0:
+        resultdict['Costes_P'].append(costesPValue(ip1, ip2, n_randomizations,
+                                                   block_size, executor))
 
     return
+
+def unsignedPixels(ip):
+    """
+    Gives access to the pixel intensities of an ImageProcessor without
+    copying them. Java bytes and shorts are signed, so 8- and 16-bit
+    pixels are masked back to their unsigned values on the fly.
+
+    Args:
+        ip: ImageProcessor
+
+    Returns:
+        iterable over the pixel values of ip, in the order of getPixels()
+    """
+    pixels = ip.getPixels()
+    bit_depth = ip.getBitDepth()
+
+    if bit_depth == 8:
+        return (p & 0xff for p in pixels)
+
+    if bit_depth == 16:
+        return (p & 0xffff for p in pixels)
+
+    return pixels
+
+def colocMoments(ip1, ip2, th_G=0, th_R=0):
+    """
+    Collects every sum needed for the colocalization coefficients in one
+    single traversal of the native pixel arrays of ip1 and ip2.
+
+    Args:
+        ip1, ip2: ImageProcessors of equal size
+        th_G, th_R: threshold values for ip1 and ip2, defaults to 0
+
+    Returns:
+        dict with the pixel count 'n' and the sums 'G', 'R', 'GG', 'RR' and
+        'GR' over all pixels, the Manders sums 'Gcoloc' and 'Rcoloc', and the
+        same moments for the pixels above both thresholds, suffixed '_th'.
+        The '_th' moments are only collected if a threshold is supplied.
+    """
+    thresholdFlag = (th_G > 0) or (th_R > 0)
+
+    n = 0
+    Gsum = Rsum = GGsum = RRsum = GRsum = 0
+    Gcoloc = Rcoloc = 0
+    n_th = 0
+    Gsum_th = Rsum_th = GGsum_th = RRsum_th = GRsum_th = 0
+
+    for g, r in izip(unsignedPixels(ip1), unsignedPixels(ip2)):
+        n += 1
+        Gsum += g
+        Rsum += r
+        GGsum += g*g
+        RRsum += r*r
+        GRsum += g*r
+
+        if g > 0 and r > th_R:
+            Rcoloc += r
+        if r > 0 and g > th_G:
+            Gcoloc += g
+
+        if thresholdFlag and (g > th_G) and (r > th_R):
+            n_th += 1
+            Gsum_th += g
+            Rsum_th += r
+            GGsum_th += g*g
+            RRsum_th += r*r
+            GRsum_th += g*r
+
+    return {'n':n, 'G':Gsum, 'R':Rsum, 'GG':GGsum, 'RR':RRsum, 'GR':GRsum,
+            'Gcoloc':Gcoloc, 'Rcoloc':Rcoloc,
+            'n_th':n_th, 'G_th':Gsum_th, 'R_th':Rsum_th, 'GG_th':GGsum_th,
+            'RR_th':RRsum_th, 'GR_th':GRsum_th}
+
+def pearsonFromMoments(n, Gsum, Rsum, GGsum, RRsum, GRsum):
+    """
+    Calculates Pearson's correlation coefficient from raw moments. The
+    differences are formed before dividing, so integer pixel data gives an
+    exact numerator and denominator.
+
+    Args:
+        n: number of pixels
+        Gsum, Rsum: sums of the pixel values
+        GGsum, RRsum: sums of the squared pixel values
+        GRsum: sum of the pixelwise products
+
+    Returns:
+        float, Pearson's coefficient, 0 if undefined
+    """
+    num = n*GRsum - Gsum*Rsum
+    Gsq = n*GGsum - Gsum*Gsum
+    Rsq = n*RRsum - Rsum*Rsum
+
+    if Gsq*Rsq <= 0:
+        return 0
+
+    return num/math.sqrt(Gsq*Rsq)
+
+def calcColocalizationCoefficients(ip1, ip2, th_G=0, th_R=0):
+    """
+    Calculates M1, M2, PCC and MOC from a single pass over the pixels, see
+    colocMoments. Gives the same numbers as calcMandersCoefficients,
+    calcPearsonsCoefficient and calcOverlapCoefficient called with the same
+    thresholds.
+
+    Args:
+        ip1, ip2: ImageProcessors of equal size
+        th_G, th_R: threshold values for ip1 and ip2, defaults to 0
+
+    Returns:
+        floats M1, M2, Pearson, overlap_coefficient
+    """
+    mom = colocMoments(ip1, ip2, th_G, th_R)
+
+    if mom['G']*mom['R'] == 0:
+        m1, m2 = 0, 0
+    else:
+        m1 = mom['Gcoloc']/float(mom['G'])
+        m2 = mom['Rcoloc']/float(mom['R'])
+
+    if (th_G > 0) or (th_R > 0):
+        pearson = pearsonFromMoments(mom['n_th'], mom['G_th'], mom['R_th'],
+                                     mom['GG_th'], mom['RR_th'], mom['GR_th'])
+    else:
+        pearson = pearsonFromMoments(mom['n'], mom['G'], mom['R'],
+                                     mom['GG'], mom['RR'], mom['GR'])
+
+    if mom['GG']*mom['RR'] == 0:
+        overlap = 0
+    else:
+        overlap = mom['GR']/math.sqrt(mom['GG']*mom['RR'])
+
+    return m1, m2, pearson, overlap
     
 def calcOverlapCoefficient(ip1, ip2):
     """
@@ -342,17 +1111,295 @@ def thresholder(Ch1_pix, Ch2_pix, Th1, Th2):
 
     return out1, out2
     
-def getLinfit(ch1_pix, ch2_pix): ##TODO implement this
-    
+def jointHistogram(ip1, ip2, n_bins=64):
     """
-    Calculates the Costes threshold, T, as defined in Costes et al. (2004)
-    The a and b constnants from the linear least square fit of Ch1 & Ch2 pixels
-    is used to calculate T for ch2.
+    Builds the joint 2D intensity histogram of two ImageProcessors in a
+    single pass. Every bin also keeps the exact sums of its pixels, so the
+    moments of any region of bins can be read out without rescanning.
+
+    Args:
+        ip1, ip2: ImageProcessors of equal size
+        n_bins: number of bins per channel, defaults to 64
+
+    Returns:
+        dict holding 'n_bins', the bin widths 'w_G' & 'w_R', the flag
+        'integer' and the suffix tables 'n', 'G', 'R', 'GG', 'RR', 'GR'.
+        Entry [i*(n_bins+1) + j] of a table is the sum over all bins with
+        ch1 bin index >= i and ch2 bin index >= j.
+    """
+    integer = ip1.getBitDepth() in (8, 16) and ip2.getBitDepth() in (8, 16)
+    max_G = ImageStatistics.getStatistics(ip1, Measurements.MIN_MAX, None).max
+    max_R = ImageStatistics.getStatistics(ip2, Measurements.MIN_MAX, None).max
+
+    if integer:
+        w_G = max(1, int(math.ceil((max_G+1)/float(n_bins))))
+        w_R = max(1, int(math.ceil((max_R+1)/float(n_bins))))
+    else:
+        w_G = max_G/float(n_bins) if max_G > 0 else 1.0
+        w_R = max_R/float(n_bins) if max_R > 0 else 1.0
+
+    stride = n_bins+1
+    keys = ['n', 'G', 'R', 'GG', 'RR', 'GR']
+    tables = dict([(key, [0]*(stride*stride)) for key in keys])
+    t_n, t_G, t_R = tables['n'], tables['G'], tables['R']
+    t_GG, t_RR, t_GR = tables['GG'], tables['RR'], tables['GR']
+    top = n_bins-1
+
+    for g, r in izip(unsignedPixels(ip1), unsignedPixels(ip2)):
+        i = min(max(int(g/w_G), 0), top)
+        j = min(max(int(r/w_R), 0), top)
+        k = i*stride + j
+        t_n[k] += 1
+        t_G[k] += g
+        t_R[k] += r
+        t_GG[k] += g*g
+        t_RR[k] += r*r
+        t_GR[k] += g*r
+
+    # Turn the histogram into suffix sums, row and column n_bins stay 0
+    for key in keys:
+        t = tables[key]
+        for i in range(top, -1, -1):
+            for j in range(top, -1, -1):
+                k = i*stride + j
+                t[k] += t[k+stride] + t[k+1] - t[k+stride+1]
+
+    hist = {'n_bins':n_bins, 'w_G':w_G, 'w_R':w_R, 'integer':integer}
+    hist.update(tables)
+
+    return hist
+
+def histogramMoments(hist, i=0, j=0):
+    """
+    Returns the moments n, G, R, GG, RR, GR of all pixels with a ch1 bin
+    index >= i and a ch2 bin index >= j, (0, 0) gives all pixels.
+    """
+    k = i*(hist['n_bins']+1) + j
+
+    return [hist[key][k] for key in ['n', 'G', 'R', 'GG', 'RR', 'GR']]
+
+def getLinfit(hist):
+    """
+    Orthogonal least squares fit, ch2 = a * ch1 + b, of all pixels in a
+    joint histogram, as used for the Costes threshold in Costes et al. (2004)
+
+    Args:
+        hist: dict, as returned by jointHistogram
+
+    Returns:
+        floats a, b. None, None if the channels are uncorrelated
+    """
+    n, G, R, GG, RR, GR = histogramMoments(hist)
+    Gvar = n*GG - G*G
+    Rvar = n*RR - R*R
+    cov = n*GR - G*R
+
+    if cov == 0:
+        return None, None
+
+    diff = float(Rvar - Gvar)
+    a = (diff + math.sqrt(diff**2 + 4.0*cov**2)) / (2.0*cov)
+    b = (R - a*G) / float(n)
+
+    return a, b
+
+def costesThreshold(ip1, ip2, n_bins=64):
     """
-    fitter = CurveFitter(ch1_pix, ch1_pix)
-    fitter.doFit(CurveFitter.STRAIGHT_LINE)
+    Calculates the Costes thresholds, as defined in Costes et al. (2004).
+    The ch1 threshold is lowered along the regression line until the
+    pixels below the thresholds no longer correlate. The search walks
+    down the bins of the joint histogram, so each step costs O(1) instead
+    of a pass over the pixels. Pearson's coefficient below the thresholds
+    is not monotonic in the threshold, so every bin is tried from the top.
+
+    Args:
+        ip1, ip2: ImageProcessors of equal size
+        n_bins: number of histogram bins per channel, defaults to 64
+
+    Returns:
+        floats th_G, th_R, threshold values for ip1 and ip2. 0, 0 if no
+        positive correlation was found
+    """
+    hist = jointHistogram(ip1, ip2, n_bins)
+    a, b = getLinfit(hist)
+
+    if (a is None) or (a <= 0):
+        return 0, 0
+
+    total = histogramMoments(hist)
+    top = n_bins-1
+
+    def binThresholds(t):
+        # Pixels in bins > t are above threshold, see jointHistogram
+        if hist['integer']:
+            th_G = (t+1)*hist['w_G'] - 1
+        else:
+            th_G = (t+1)*hist['w_G']
+
+        t_R = min(max(int((a*th_G + b)/hist['w_R']), -1), top)
+
+        if hist['integer']:
+            th_R = (t_R+1)*hist['w_R'] - 1
+        else:
+            th_R = (t_R+1)*hist['w_R']
 
-    return fitter
+        return th_G, th_R, t_R
+
+    def pearsonBelow(t):
+        t_R = binThresholds(t)[2]
+        above = histogramMoments(hist, t+1, t_R+1)
+        below = [tot-ab for tot, ab in zip(total, above)]
+
+        return pearsonFromMoments(*below)
+
+    for t in range(top, -1, -1):
+        if pearsonBelow(t) <= 0:
+            th_G, th_R = binThresholds(t)[:2]
+            return th_G, max(th_R, 0)
+
+    return 0, 0
+
+# Block layouts already computed, keyed by (width, height, block_size)
+block_layouts = {}
+
+# Most blocks whose block-to-block products costesPValue tabulates
+max_dot_blocks = 1024
+
+def blockLayout(width, height, block_size):
+    """
+    Tiles a crop in square blocks for the Costes randomization. Pixels in
+    the incomplete blocks along the right and bottom edges are left out.
+    The layout is computed once per crop size and then cached.
+
+    Args:
+        width, height: size of the crop in pixels
+        block_size: side of the blocks in pixels
+
+    Returns:
+        list of blocks, each a list of pixel indices in the crop
+    """
+    key = (width, height, block_size)
+
+    if key not in block_layouts:
+        blocks = []
+        for by in range(0, height - block_size + 1, block_size):
+            for bx in range(0, width - block_size + 1, block_size):
+                blocks.append([(by+y)*width + bx+x
+                               for y in range(block_size)
+                               for x in range(block_size)])
+        block_layouts[key] = blocks
+
+    return block_layouts[key]
+
+class ShuffleTask(Callable):
+    """
+    Calculates Pearson's coefficient for a range of block scrambled
+    versions of ch1 against the unchanged ch2. Shuffle number i is always
+    drawn with seed + i, so the result does not depend on the number of
+    threads.
+    """
+    def __init__(self, G_blocks, R_blocks, dots, moments, first, last, seed):
+        """
+        Args:
+            G_blocks, R_blocks: pixel values of the blocks of ch1 and ch2
+            dots: dots[a][b] is the sum of ch1 block a times ch2 block b,
+              or None to multiply the blocks for every shuffle
+            moments: [n, G, R, GG, RR], invariant under scrambling
+            first, last: range of shuffle numbers to run
+            seed: int, base seed
+        """
+        self.G_blocks = G_blocks
+        self.R_blocks = R_blocks
+        self.dots = dots
+        self.moments = moments
+        self.first = first
+        self.last = last
+        self.seed = seed
+
+    def call(self):
+        n, Gsum, Rsum, GGsum, RRsum = self.moments
+        out = []
+
+        for i in range(self.first, self.last):
+            order = range(len(self.G_blocks))
+            random.Random(self.seed + i).shuffle(order)
+            GRsum = 0
+            for dst, src in enumerate(order):
+                if self.dots is None:
+                    GRsum += sum([g*r for g, r in izip(self.G_blocks[src],
+                                                       self.R_blocks[dst])])
+                else:
+                    GRsum += self.dots[src][dst]
+            out.append(pearsonFromMoments(n, Gsum, Rsum, GGsum, RRsum,
+                                          GRsum))
+
+        return out
+
+def costesPValue(ip1, ip2, n_randomizations, block_size, executor, seed=0):
+    """
+    Costes et al. (2004) randomization test for Pearson's coefficient.
+    Ch1 is scrambled block wise and the coefficient is recalculated each
+    time. Scrambling only permutes the blocks, so with few blocks the
+    block-to-block products are calculated once and each randomization
+    is a sum over the blocks. The table costs as much as one
+    randomization per block and holds nblocks^2 sums, so with more blocks
+    than randomizations, or above max_dot_blocks, each randomization
+    multiplies the scrambled blocks directly instead. The randomizations
+    are spread over the executor.
+
+    Args:
+        ip1, ip2: ImageProcessors of equal size
+        n_randomizations: number of scrambled images
+        block_size: side of the scrambled blocks in pixels, ideally the
+          size of the PSF
+        executor: ExecutorService to run the randomizations on, if None
+          they run on the calling thread
+        seed: int, base seed of the shuffles, defaults to 0
+
+    Returns:
+        float, the fraction of randomized coefficients below the observed
+        one. Values above 0.95 indicate significant colocalization
+    """
+    blocks = blockLayout(ip1.getWidth(), ip1.getHeight(), block_size)
+
+    if len(blocks) < 2:
+        return 0
+
+    G = list(unsignedPixels(ip1))
+    R = list(unsignedPixels(ip2))
+    G_blocks = [[G[i] for i in block] for block in blocks]
+    R_blocks = [[R[i] for i in block] for block in blocks]
+
+    dots = None
+    if len(blocks) <= min(n_randomizations, max_dot_blocks):
+        dots = [[sum([g*r for g, r in izip(G_block, R_block)])
+                 for R_block in R_blocks] for G_block in G_blocks]
+
+    moments = [len(blocks)*block_size**2,
+               sum([sum(block) for block in G_blocks]),
+               sum([sum(block) for block in R_blocks]),
+               sum([g*g for block in G_blocks for g in block]),
+               sum([r*r for block in R_blocks for r in block])]
+
+    GRsum = sum([g*r for G_block, R_block in izip(G_blocks, R_blocks)
+                 for g, r in izip(G_block, R_block)])
+    observed = pearsonFromMoments(*(moments + [GRsum]))
+
+    if executor is None:
+        randomized = ShuffleTask(G_blocks, R_blocks, dots, moments, 0,
+                                 n_randomizations, seed).call()
+    else:
+        n_tasks = min(Prefs.getThreads(), n_randomizations)
+        edges = [n_randomizations*t//n_tasks for t in range(n_tasks+1)]
+        tasks = [ShuffleTask(G_blocks, R_blocks, dots, moments, edges[t],
+                             edges[t+1], seed) for t in range(n_tasks)]
+        randomized = []
+        for future in executor.invokeAll(tasks):
+            randomized += future.get()
+
+    below = len([r for r in randomized if r < observed])
+
+    return below/float(n_randomizations)
 
     
 # Start by getting the ImagePlus object in the active ImageJ window
@@ -372,7 +1419,8 @@ gd = setupDialog(imp)
 frame_interval = gd.getNextNumber()
 time_unit = gd.getNextString()
 channel_to_track = int(gd.getNextChoice())
-roi_to_use = gd.getNextChoiceIndex() #0 for current, 1 for first in ROImanager
+roi_to_use = gd.getNextChoiceIndex() #0 for current, 1 for first, 2 for all
+prediction_mode = gd.getNextChoiceIndex() #index in prediction_modes
 no_of_centerings = int(gd.getNextNumber())
 analsis_roi_diameter = int(gd.getNextNumber())
 start_frame = int(gd.getNextNumber())
@@ -395,6 +1443,28 @@ showCropFlag=gd.getNextBoolean()
 analysisRoiFlag=gd.getNextBoolean()
 colocalizationFlag=gd.getNextBoolean()
 showColPlotFlag=gd.getNextBoolean()
+costesFlag=gd.getNextBoolean()
+randomizationFlag=gd.getNextBoolean()
+n_randomizations = int(gd.getNextNumber())
+block_size = int(gd.getNextNumber())
+convergeFlag=gd.getNextBoolean()
+centering_tolerance = gd.getNextNumber()
+
+overlayFlag=gd.getNextBoolean()
+flattenFlag=gd.getNextBoolean()
+streamCropFlag=gd.getNextBoolean()
+prefetch_depth = max(0, int(gd.getNextNumber()))
+
+# The overlay replaces the pixel copies of the tracked channel
+if overlayFlag:
+    showTrackFlag = False
+
+# No tolerance means a fixed number of centerings per frame
+if not convergeFlag:
+    centering_tolerance = 0
+
+if not (colocalizationFlag and randomizationFlag):
+    n_randomizations = 0
 
 # Set the frame interval in the calibration and store it back to the
 # ImageProcessor
@@ -408,6 +1478,13 @@ stack = imp.getImageStack()
 
 # Creates an empty stack with the same dimensions as imp
 stack_track = imp.createEmptyStack() 
+
+# Tracking overlay, added to any overlay the image already has
+if overlayFlag:
+    overlay = imp.getOverlay()
+    if overlay is None:
+        overlay = Overlay()
+    stack_flat = ImageStack(imp.getWidth(), imp.getHeight())
 
 title = imp.getTitle()
 n_channels = imp.getNChannels()
@@ -415,20 +1492,36 @@ slice_to_track = 1 #Z-stack tracking is not implemented
 
 
 
-# Get the chosen tracking ROI
+# Get the chosen tracking ROI(s)
+multiObjectFlag = (roi_to_use == 2)
+
 if (roi_to_use == 0) and (imp.getRoi() is not None):
-    roi_1 = imp.getRoi()
+    seed_rois = [imp.getRoi()]
 
 else: #TODO proper exception handling in case there are no ROIs
     roi_manager = RoiManager.getInstance()
     roi_list    = roi_manager.getRoisAsArray()
-    roi_1 = roi_list[0]
+    
+    if multiObjectFlag:
+        seed_rois = list(roi_list)
+    else:
+        seed_rois = [roi_list[0]]
 
-# Get position and size of ROI
-roi_x=roi_1.getXBase()
-roi_y=roi_1.getYBase()
-roi_w=roi_1.getFloatWidth()
-roi_h=roi_1.getFloatHeight()
+# Get position and size of the ROIs, one track per ROI
+tracks = [[roi.getXBase(), roi.getYBase(), roi.getFloatWidth(),
+           roi.getFloatHeight()] for roi in seed_rois]
+
+roi_w=tracks[0][2]
+roi_h=tracks[0][3]
+
+# Seeds the centering of each object in the next frame
+predictors = [TrackPredictor(x, y, prediction_mode) for x, y, w, h in tracks]
+
+# Crops and plots are only made for single object tracking
+if multiObjectFlag:
+    showCropFlag = False
+    showPlotFlag = False
+    showColPlotFlag = False
 
 # In case we are analyzing a smaller region than we track
 if analysisRoiFlag: 
@@ -437,13 +1530,39 @@ if analysisRoiFlag:
 else:
     stack_crop = ImageStack(int(roi_w), int(roi_h))
 
+# Long tracks are written to disk as they go instead of stacked in memory
+crop_writer = None
+if showCropFlag and streamCropFlag:
+    sd = SaveDialog("Stream cropped region to", title+"_analysis_crop",
+                    ".tif")
+    if sd.getFileName() is None:
+        IJ.log("No file chosen, keeping the cropped region in memory")
+    else:
+        crop_writer = TiffStreamWriter(sd.getDirectory()+sd.getFileName(),
+                                       2)
+
 
 # A dictionary to keep track of results
 result_dict={}
 result_keys=['means_ch1','means_ch2','ch1x','ch1y','ch2x','ch2y']
+
+# Long format, one row per object and frame
+if multiObjectFlag:
+    result_keys = ['object', 'frame'] + result_keys
+
+if convergeFlag:
+    result_keys.append('centerings')
+
+if prediction_mode > 0:
+    result_keys.append('innovation')
     
 if colocalizationFlag:
     extra_keys=['M1', 'M2', 'Pearson', 'overlap_coefficient']
+    if costesFlag:
+        extra_keys += ['Costes_th_ch1', 'Costes_th_ch2', 'tM1', 'tM2',
+                       'tPearson']
+    if n_randomizations > 0:
+        extra_keys.append('Costes_P')
     for extra in extra_keys: 
         result_keys.append(extra)
     
@@ -451,61 +1570,140 @@ for key in result_keys:
     # each key holds a list of results
     result_dict[key]=[]    
 
-#loop through the frames that you want to track
-for frame in range(start_frame, stop_frame+1):
-    # Get the ImageProcessor of the channel to track at the current frame
-    track_ip = stack.getProcessor(imp.getStackIndex(channel_to_track,
-                                  slice_to_track, frame))
-    
-    track_roi = OvalRoi(roi_x, roi_y, roi_w, roi_h)
-    
-    #Do the Roi centering the desired number of times
-    for i in range (no_of_centerings):
-        track_roi=roiCenterer(track_ip, track_roi, cal)
-    
-    roi_x=track_roi.getXBase()
-    roi_y=track_roi.getYBase()
-    track_ip.setRoi(track_roi)
-
-    if analysisRoiFlag:
-        analysis_roi=roiScaler(track_roi, analsis_roi_diameter)
-    else:
-        analysis_roi=track_roi.clone()
-    
-    #Get Channel 1&2 IPs and apply the centered roi with the desired diameter
-    
-    ip1 = stack.getProcessor(imp.getStackIndex(1, slice_to_track, frame))
-    ip1_crop=channelStats(ip1, 1, analysis_roi, result_dict, cal)
-    
-    ip2 = stack.getProcessor(imp.getStackIndex(2,slice_to_track,frame))
-    ip2_crop=channelStats(ip2, 2, analysis_roi, result_dict, cal)
-
-    if colocalizationFlag:
-        colocRecorder(ip1_crop, ip2_crop, result_dict)
-
-    if showTrackFlag:
-        ip_track=track_ip.duplicate()
-        ip_track.setColor(track_ip.maxValue())
-        ip_track.draw(track_roi)
-        
-        if analysisRoiFlag:
-            ip_track.setColor(track_ip.maxValue()/2)
-            ip_track.draw(analysis_roi)
-        stack_track.addSlice(ip_track)
+# Worker threads for the Roi centering and the Costes randomizations
+if multiObjectFlag or (n_randomizations > 0):
+    executor = Executors.newFixedThreadPool(Prefs.getThreads())
+else:
+    executor = None
 
-    if showCropFlag:       
-        #ip_crop.setColor(ip.maxValue())
-        #ip_crop.draw(analysis_roi)
-        stack_crop.addSlice(ip1_crop)
-        stack_crop.addSlice(ip2_crop)
+# Loads the ImageProcessors of the coming frames while one is analysed,
+# each channel only once
+prefetcher = FramePrefetcher(stack, imp, [channel_to_track, 1, 2],
+                             slice_to_track,
+                             range(start_frame, stop_frame+1), prefetch_depth)
 
+#loop through the frames that you want to track
+try:
+    for frame, ips in prefetcher:
+        track_ip = ips[channel_to_track]
+
+        track_rois = []
+        for predictor, track in zip(predictors, tracks):
+            seed_x, seed_y = predictor.predict()
+            track_rois.append(OvalRoi(seed_x, seed_y, track[2], track[3]))
+
+        #Do the Roi centering the desired number of times, for all objects
+        track_rois, centerings = centerRois(track_ip, track_rois,
+                                            no_of_centerings, cal, executor,
+                                            centering_tolerance)
+
+        if showTrackFlag:
+            ip_track=track_ip.duplicate()
+
+        frame_rois = []
+
+        for obj, track_roi in enumerate(track_rois):
+            tracks[obj][0]=track_roi.getXBase()
+            tracks[obj][1]=track_roi.getYBase()
+
+            if analysisRoiFlag:
+                analysis_roi=roiScaler(track_roi, analsis_roi_diameter)
+            else:
+                analysis_roi=track_roi.clone()
+
+            if multiObjectFlag:
+                result_dict['object'].append(obj+1)
+                result_dict['frame'].append(frame)
+
+            if convergeFlag:
+                result_dict['centerings'].append(centerings[obj])
+
+            innovation = predictors[obj].update(tracks[obj][0], tracks[obj][1])
+
+            if prediction_mode > 0:
+                result_dict['innovation'].append(innovation)
+
+            #Apply the centered roi with the desired diameter to Channel 1&2 IPs
+
+            ip1_crop=channelStats(ips[1], 1, analysis_roi, result_dict, cal)
+            ip2_crop=channelStats(ips[2], 2, analysis_roi, result_dict, cal)
+
+            if colocalizationFlag:
+                colocRecorder(ip1_crop, ip2_crop, result_dict, costesFlag,
+                              n_randomizations, block_size, executor)
+
+            if showTrackFlag:
+                ip_track.setColor(track_ip.maxValue())
+                ip_track.draw(track_roi)
+
+                if analysisRoiFlag:
+                    ip_track.setColor(track_ip.maxValue()/2)
+                    ip_track.draw(analysis_roi)
+
+            if overlayFlag:
+                frame_rois.append(positionedRoi(track_roi, Color.YELLOW, imp,
+                                                channel_to_track, slice_to_track,
+                                                frame))
+                if analysisRoiFlag:
+                    frame_rois.append(positionedRoi(analysis_roi, Color.CYAN, imp,
+                                                    channel_to_track,
+                                                    slice_to_track, frame))
+
+            if showCropFlag:       
+                #ip_crop.setColor(ip.maxValue())
+                #ip_crop.draw(analysis_roi)
+                if crop_writer is not None:
+                    crop_writer.append(ip1_crop)
+                    crop_writer.append(ip2_crop)
+                else:
+                    stack_crop.addSlice(ip1_crop)
+                    stack_crop.addSlice(ip2_crop)
+
+        if showTrackFlag:
+            stack_track.addSlice(ip_track)
+
+        if overlayFlag:
+            for roi in frame_rois:
+                overlay.add(roi)
+            if flattenFlag:
+                stack_flat.addSlice(flattenFrame(track_ip, frame_rois))
+finally:
+    prefetcher.close()
+    if executor is not None:
+        executor.shutdown()
+    # A failed run still leaves a complete TIFF of the frames done so far
+    if crop_writer is not None:
+        crop_path = crop_writer.close()
+
+if convergeFlag:
+    IJ.log("Roi centerings per frame: %.2f on average, %d at most (cap %d)"
+           % (sum(result_dict['centerings'])/
+              float(len(result_dict['centerings'])),
+              max(result_dict['centerings']), no_of_centerings))
 
 if showTrackFlag:    
     imp_track = ImagePlus(title+'_Processed', stack_track)
     imp_track.setCalibration(cal)
     imp_track.show()
 
-if showCropFlag:
+if overlayFlag:
+    imp.setOverlay(overlay)
+
+    if flattenFlag:
+        imp_flat = ImagePlus(title+'_Tracking', stack_flat)
+        imp_flat.setCalibration(cal)
+        imp_flat.show()
+
+if crop_writer is not None:
+    if crop_path is not None:
+        imp_crop = FileInfoVirtualStack.openVirtual(crop_path)
+        imp_crop.setTitle(title+"_analysis_crop")
+        imp_crop.setDimensions(2, 1, no_frames_tracked)
+        imp_crop.setOpenAsHyperStack(True)
+        imp_crop.setCalibration(cal)
+        imp_crop.show()
+
+elif showCropFlag:
     imp_crop = IJ.createHyperStack(title+"_analysis_crop", int(roi_w),
                                    int(roi_h), n_channels, 1, no_frames_tracked,
                                    imp.getBitDepth())
@@ -516,7 +1714,7 @@ if showCropFlag:
 if showResultsFlag:
     IJ.run("Clear Results")
     rt=ResultsTable()
-    for index in range(no_frames_tracked):
+    for index in range(len(result_dict['means_ch1'])):
         rt.incrementCounter()
         for key in result_keys:
             rt.addValue(str(key),result_dict[key][index])
@@ -1,11 +1,16 @@
 #import ij.gui
-from ij.plugin import ZProjector, Duplicator
+from ij.plugin import ZProjector, FolderOpener, HyperStackConverter
 
 from ij import WindowManager as WindowManager
 from ij import IJ, ImagePlus, ImageStack
 from ij import IJ as IJ
 from ij.gui import GenericDialog
+from ij.process import Blitter
+from ij.io import DirectoryChooser
+from java.lang import RuntimeException
 import math
+import os
+import hashlib
 
 
 def setupDialog(imp):
@@ -27,14 +32,125 @@ def setupDialog(imp):
     
     
     gd.addChoice('Method to use for frame projection:', methods_as_strings, methods_as_strings[1])
+    gd.addCheckbox("Stream frames from disk and save compacted frames as they are made", imp.getStack().isVirtual())
+    gd.addCheckbox("Cache 2x, 4x, 8x... compacted frames next to the image in a temporal pyramid", False)
     gd.showDialog()  
-	  
+
     if gd.wasCanceled():  
         IJ.log("User canceled dialog!")  
         return
 
     return gd
 
+
+def compactFrames(imp, channel, start, stop, method):
+    #Projects frames start to stop of a channel, reading them one at a time
+    window = ImageStack(imp.getWidth(), imp.getHeight())
+    stack = imp.getStack()
+    for frame in range(start, stop+1):
+        window.addSlice(stack.getProcessor(imp.getStackIndex(channel, imp.getSlice(), frame)))
+
+    zp = ZProjector(ImagePlus("window", window))
+    zp.setMethod(method)
+    zp.setStartSlice(1)
+    zp.setStopSlice(window.getSize())
+    zp.doProjection()
+    return zp.getProjection().getProcessor()
+
+
+def imagePath(imp):
+    #Returns the path of the file the image was opened from, None if it is
+    #unsaved or changed since, its pixels could not be identified then
+    file_info = imp.getOriginalFileInfo()
+    if file_info is None or not file_info.directory or not file_info.fileName or imp.changes:
+        return None
+    path = os.path.join(file_info.directory, file_info.fileName)
+    if not os.path.isfile(path):
+        return None
+    return path
+
+
+def pyramidFolder(imp, start, stop, method):
+    #The folder of the pyramid of an image, next to the image file. Its name
+    #holds a digest of the file, when it was last changed, its size and the
+    #image dimensions, so a different or re-saved movie gets a pyramid of its own
+    path = imagePath(imp)
+    identity = "|".join(str(value) for value in [path, os.path.getmtime(path), os.path.getsize(path),
+                        imp.getWidth(), imp.getHeight(), imp.getNChannels(), imp.getNSlices(),
+                        imp.getNFrames(), imp.getBitDepth()])
+    key = "%s_z%d_t%d-%d_%s_%s" % (imp.getTitle(), imp.getSlice(), start, stop, pyramid_methods[method][0],
+                                   hashlib.md5(identity).hexdigest()[:12])
+    return os.path.join(os.path.dirname(path), imp.getTitle()+"_pyramid", key)
+
+
+def pyramidFramePath(folder, t, channel):
+    return os.path.join(folder, "t%06d_c%03d.tif" % (t+1, channel))
+
+
+def pyramidFrame(folder, t, channel):
+    #Frame t (0-based) of a channel of a pyramid level, read from disk
+    return IJ.openImage(pyramidFramePath(folder, t, channel)).getProcessor()
+
+
+def pyramidComplete(folder, n_frames, imp):
+    #A level is only used if it was finished, for an image of the same size
+    marker = os.path.join(folder, "complete.txt")
+    if not os.path.isfile(marker):
+        return False
+    f = open(marker)
+    dimensions = f.read().strip()
+    f.close()
+    if dimensions != "%d %d %d %d" % (n_frames, imp.getNChannels(), imp.getWidth(), imp.getHeight()):
+        return False
+    ip = pyramidFrame(folder, 0, 1)
+    return ip.getWidth() == imp.getWidth() and ip.getHeight() == imp.getHeight()
+
+
+def pyramidLevel(imp, start, stop, method, level, folder):
+    #Returns the folder of the frames start to stop binned by 2**level, one
+    #file per frame and channel. Every level is made by combining pairs of
+    #frames of the level below and written frame by frame, so only two frames
+    #are in memory, and kept on disk to be used again. Average is kept as a
+    #sum, divide by the counts
+    name, mode = pyramid_methods[method]
+    n_channels = imp.getNChannels()
+    n_frames = -(-(stop - start + 1) // 2**level)
+    level_folder = os.path.join(folder, "x%d" % 2**level)
+    if pyramidComplete(level_folder, n_frames, imp):
+        return level_folder
+
+    if level == 1:
+        stack = imp.getStack()
+        frame = lambda t, channel: stack.getProcessor(imp.getStackIndex(channel, imp.getSlice(), start+t))
+        n_below = stop - start + 1
+    else:
+        below = pyramidLevel(imp, start, stop, method, level-1, folder)
+        frame = lambda t, channel: pyramidFrame(below, t, channel)
+        n_below = -(-(stop - start + 1) // 2**(level-1))
+
+    if not os.path.isdir(level_folder):
+        os.makedirs(level_folder)
+    for t in range(0, n_below, 2):
+        for channel in range(1, n_channels+1):
+            ip = frame(t, channel)
+            if name == 'sum':
+                ip = ip.convertToFloat()
+            ip = ip.duplicate()
+            #an odd frame out at the end is carried over on its own
+            if t+1 < n_below:
+                other = frame(t+1, channel)
+                if name == 'sum':
+                    other = other.convertToFloat()
+                ip.copyBits(other, 0, 0, mode)
+            IJ.saveAsTiff(ImagePlus("", ip), pyramidFramePath(level_folder, t//2, channel))
+        IJ.showProgress(t+2, n_below)
+
+    f = open(os.path.join(level_folder, "complete.txt"), "w")
+    f.write("%d %d %d %d" % (n_frames, n_channels, imp.getWidth(), imp.getHeight()))
+    f.close()
+    return level_folder
+
+
 #Start by getting the active image window and creating a ZProjector object from it
 imp = WindowManager.getCurrentImage()
 cal = imp.getCalibration()
@@ -45,6 +161,10 @@ methods_as_strings=['Average Intensity', 'Max Intensity', 'Min Intensity', 'Sum
 methods_as_const=[zp.AVG_METHOD, zp.MAX_METHOD, zp.MIN_METHOD, zp.SUM_METHOD, zp.SD_METHOD, zp.MEDIAN_METHOD]
 medthod_dict=dict(zip(methods_as_strings, methods_as_const))
 
+#Methods whose compacted frames can be made by combining pairs of compacted frames
+pyramid_methods={zp.AVG_METHOD: ('sum', Blitter.ADD), zp.MAX_METHOD: ('max', Blitter.MAX),
+                 zp.MIN_METHOD: ('min', Blitter.MIN), zp.SUM_METHOD: ('sum', Blitter.ADD)}
+
 # Run the setupDialog, read out and store the options
 gd=setupDialog(imp)
 frame_interval = gd.getNextNumber()
@@ -63,30 +183,69 @@ if (start_frame > stop_frame):
     IJ.showMessage("Start frame > Stop frame!")
     raise RuntimeException("Start frame > Stop frame!")
 
-if ((start_frame != 1) or (stop_frame != imp.getNFrames())):
-    imp = Duplicator().run(imp, start_frame, stop_frame);
-    #imp.show();
-
-#The Z-Projection magic happens here
-total_no_frames_to_project=imp.getNFrames()
+#Frames are read one by one from the stack, which may be virtual, so only the
+#frames of one compacted frame are held in memory at a time
 no_frames_per_integral = int(gd.getNextNumber())
-
 chosen_method=medthod_dict[gd.getNextChoice()]
-zp.setMethod(chosen_method)
-zp.setStartSlice(1)
-zp.setStopSlice(10)
-zp.doProjection()
-zp1=zp.getProjection()
-    
-
-    
-
-stack = imp.getImageStack()
-stack_track = imp.createEmptyStack()
+streamFlag = gd.getNextBoolean()
+pyramidFlag = gd.getNextBoolean()
 
 title = imp.getTitle()
 n_channels = imp.getNChannels()
+output_title = title+"_compacted_"+str(no_frames_per_integral)
+
+if streamFlag:
+    folder = DirectoryChooser("Folder to save the compacted frames in").getDirectory()
+    if folder is None:
+        raise RuntimeException("No folder chosen for the compacted frames!")
+    #a new folder of its own, the compacted frames are reopened as all files
+    #in it, so earlier runs must not be mixed in
+    path = os.path.join(folder, output_title)
+    folder, number = path, 1
+    while os.path.exists(folder):
+        number += 1
+        folder = path+"_"+str(number)
+    os.makedirs(folder)
+else:
+    stack_track = imp.createEmptyStack()
+
+#Compacting by a power of 2 is a lookup in the temporal pyramid
+pyramidFlag = (pyramidFlag and chosen_method in pyramid_methods and no_frames_per_integral > 1
+               and not no_frames_per_integral & (no_frames_per_integral-1))
+if pyramidFlag and imagePath(imp) is None:
+    IJ.log("The temporal pyramid needs an image saved with no changes since, compacting directly")
+    pyramidFlag = False
+if pyramidFlag:
+    level = int(round(math.log(no_frames_per_integral, 2)))
+    level_folder = pyramidLevel(imp, start_frame, stop_frame, chosen_method, level,
+                                pyramidFolder(imp, start_frame, stop_frame, chosen_method))
 
-
-
-
+#The Z-Projection magic happens here
+starts = range(start_frame, stop_frame+1, no_frames_per_integral)
+for i, start in enumerate(starts):
+    stop = min(start+no_frames_per_integral-1, stop_frame)
+    for channel in range(1, n_channels+1):
+        if pyramidFlag:
+            ip = pyramidFrame(level_folder, i, channel)
+            if chosen_method == zp.AVG_METHOD:
+                ip.multiply(1.0/(stop-start+1))
+        else:
+            ip = compactFrames(imp, channel, start, stop, chosen_method)
+        if streamFlag:
+            file_name = "%s_t%0*d_c%0*d.tif" % (output_title, len(str(len(starts))), i+1, len(str(n_channels)), channel)
+            IJ.saveAsTiff(ImagePlus(file_name, ip), os.path.join(folder, file_name))
+        else:
+            stack_track.addSlice(ip)
+    IJ.showProgress(i+1, len(starts))
+
+if streamFlag:
+    imp2 = FolderOpener.open(folder, "virtual")
+    imp2.setTitle(output_title)
+else:
+    imp2 = ImagePlus(output_title, stack_track)
+
+imp2 = HyperStackConverter.toHyperStack(imp2, n_channels, 1, len(starts))
+cal2 = cal.copy()
+cal2.frameInterval = frame_interval*no_frames_per_integral
+imp2.setCalibration(cal2)
+imp2.show()
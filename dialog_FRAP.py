@@ -4,14 +4,13 @@ from ij.plugin.frame import RoiManager as RoiManager
 from ij.process import ImageStatistics as ImageStatistics
 from ij.measure import Measurements as Measurements
 from ij import IJ as IJ
+from ij import ImagePlus, ImageStack
 from ij.measure import CurveFitter as CurveFitter
 from ij.gui import Plot as Plot
 from ij.gui import PlotWindow as PlotWindow
 import math
 
 from ij.gui import GenericDialog  
-from ij.plugin import ChannelSplitter
-
 
 
 def FRAPsetup(imp):
@@ -36,16 +35,16 @@ def FRAPsetup(imp):
 		
 	gd.showDialog()  
 	  
-  	if gd.wasCanceled():  
+	if gd.wasCanceled():  
 		IJ.log("User canceled dialog!")  
 		return  
-  	# Read out the options 
-  	
-  	frame_interval = gd.getNextNumber()
-  	channel = int(gd.getNextChoice())  
-  	max_frame = int(gd.getNextNumber())
-  	manual_FRAP_frame = int(gd.getNextNumber())
-  	autoFRAPflag=gd.getNextBoolean()
+	# Read out the options 
+	
+	frame_interval = gd.getNextNumber()
+	channel = int(gd.getNextChoice())  
+	max_frame = int(gd.getNextNumber())
+	manual_FRAP_frame = int(gd.getNextNumber())
+	autoFRAPflag=gd.getNextBoolean()
 
 	#Set the frame interval in calibration
 
@@ -53,18 +52,43 @@ def FRAPsetup(imp):
 	imp.setCalibration(calibration)
 	
 	#Extract the desired channel
-  	   
-  	imp=channelSelector(imp,channel)	
-  	
-  	return imp, max_frame, manual_FRAP_frame, autoFRAPflag
+	   
+	imp=channelSelector(imp,channel,max_frame)	
+	
+	return imp, max_frame, manual_FRAP_frame, autoFRAPflag
 
-def channelSelector(imp, channelno):
+def channelIndices(imp, channelno, max_frame=None):
 	'''
-	arguments imp: imageProcessor, channelno: imteger, channel number
-	returns an imp containing the desired channel
+	arguments imp: ImagePlus, channelno: integer, channel number,
+	max_frame: integer, number of images to keep, all if None
+	returns the stack indices of the images of the channel, in the order
+	ChannelSplitter would put them, up to max_frame
 	'''
-	imps=ChannelSplitter.split(imp)
-	return imps[(channelno-1)]
+	indices = []
+	for frame in range(1, imp.getNFrames()+1):
+		for z in range(1, imp.getNSlices()+1):
+			if len(indices) == max_frame:
+				return indices
+			indices.append(imp.getStackIndex(channelno, z, frame))
+	return indices
+
+def channelSelector(imp, channelno, max_frame=None):
+	'''
+	arguments imp: ImagePlus, channelno: integer, channel number,
+	max_frame: integer, number of frames to keep, all if None
+	returns an imp containing the desired channel, up to max_frame, that
+	shares its pixel arrays with imp
+	'''
+	stack = imp.getImageStack()
+	channel_stack = ImageStack(imp.getWidth(), imp.getHeight())
+	for index in channelIndices(imp, channelno, max_frame):
+		channel_stack.addSlice(stack.getSliceLabel(index),
+		                       stack.getPixels(index))
+
+	channel_imp = ImagePlus("C%d-%s" % (channelno, imp.getTitle()),
+	                        channel_stack)
+	channel_imp.setCalibration(imp.getCalibration())
+	return channel_imp
 
 
 current_imp  = WindowManager.getCurrentImage()